@@ -0,0 +1,339 @@
+'''
+Offline benchmark of the chatbot (python benchmark.py --rows 20000 --latency 0.3 --concurrency 8).
+Gemini is replaced by a local stand-in with fixed latency and canned outputs, and the VAERS files by
+synthetic ones of the requested size, so the numbers are repeatable and need no network access.
+'''
+import os
+import sys
+import io
+import json
+import time
+import types
+import shutil
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import concurrent.futures
+import numpy as np
+import pandas as pd
+try:
+    import resource
+except ImportError:    # not available on Windows, peak RSS is not reported
+    resource = None
+
+# set before importing main: no context caching or embeddings, no trace lines per request
+os.environ.setdefault('API_KEY', 'benchmark')
+os.environ['VAERS_PROMPT_CACHING'] = '0'
+os.environ['VAERS_SEMANTIC_CACHE'] = '0'
+os.environ.setdefault('VAERS_TRACE_LOG', 'WARNING')
+
+
+
+########################## Corpus ###########################
+# questions as asked in the chat, with the structured query the extract bot is expected to return
+QUESTIONS = [
+    ("Are children or seniors more susceptible to COVID vaccine side effects?",
+     {"relevant": True, "vaccines": ["COVID"], "age_groups": ["children", "old"], "info": ["symptoms", "age"]}),
+    ("What are the most common side effects from flu vaccine among children?",
+     {"relevant": True, "vaccines": ["flu"], "age_groups": ["children"], "info": ["symptoms"]}),
+    ("Do women or men get more side effects from COVID vaccines?",
+     {"relevant": True, "vaccines": ["COVID"], "info": ["symptoms", "sex"]}),
+    ("How deadly is COVID vaccine for young adults?",
+     {"relevant": True, "vaccines": ["COVID"], "age_groups": ["young adult"], "info": ["died"]}),
+    ("What is the trend of adverse event reports for polio vaccine?",
+     {"relevant": True, "vaccines": ["polio"], "info": ["ID"]}),
+    ("How many people reported headache or nausea in 2018 and 2019?",
+     {"relevant": True, "years": [2018, 2019], "symptoms": ["Headache", "Nausea"], "info": ["ID", "symptoms"]}),
+    ("Give me all the reports on TBE vaccines in recent years",
+     {"relevant": True, "vaccines": ["TBE"], "years": [2021, 2022, 2023], "info": ["symptoms", "age", "sex"]}),
+    ("Which states report the most hospitalisations after HPV vaccines?",
+     {"relevant": True, "vaccines": ["HPV"], "info": ["state", "hospital"]}),
+    ("Hello.", {"relevant": False}),
+    ("Thank you!", {"relevant": False}),
+]
+SYMPTOMS = ['Headache', 'Pyrexia', 'Fatigue', 'Injection site pain', 'Nausea', 'Dizziness', 'Chills', 'Rash',
+            'Vomiting', 'Myalgia', 'Pain', 'Malaise', 'Urticaria', 'Dyspnoea', 'Syncope', 'Death']
+ANSWER = 'Based on selected VAERS data, the reports show the following pattern. ' * 8
+
+
+
+########################## Synthetic data ###########################
+def make_dataset(root: str, years, rows: int, codes: list, seed: int = 0) -> None:
+    '''
+    Input: directory, years, reports per year, vaccine codes to draw VAX_TYPE from
+    Output: None, writes {year}VAERSData/{year}VAERS{DATA,SYMPTOMS,VAX}.csv in the layout of the VAERS downloads
+    '''
+    rng = np.random.default_rng(seed)
+    symptom_p = 1 / np.arange(1, len(SYMPTOMS) + 1)    # a few symptoms are reported much more often
+    symptom_p /= symptom_p.sum()
+    for year in years:
+        folder = f'{root}/{year}VAERSData'
+        os.makedirs(folder, exist_ok=True)
+        ids = np.arange(rows) + year * 10**6
+        age = rng.gamma(2, 20, rows).round(1)
+        data = pd.DataFrame({'VAERS_ID': ids,
+                             'RECVDATE': pd.to_datetime(rng.integers(0, 365, rows), unit='D', origin=f'{year}-01-01').strftime('%m/%d/%Y'),
+                             'STATE': rng.choice(['CA', 'TX', 'NY', 'FL', 'WA', None], rows),
+                             'AGE_YRS': np.where(rng.random(rows) < 0.1, np.nan, np.minimum(age, 105)),
+                             'SEX': rng.choice(['F', 'M', 'U'], rows, p=[0.6, 0.35, 0.05]),
+                             'SYMPTOM_TEXT': 'Patient reported symptoms after vaccination. ' * 4})
+        for flag, p in [('DIED', 0.01), ('L_THREAT', 0.01), ('ER_VISIT', 0.05), ('HOSPITAL', 0.08), ('DISABLE', 0.01), ('BIRTH_DEFECT', 0.001)]:
+            data[flag] = np.where(rng.random(rows) < p, 'Y', None)
+        data.to_csv(f'{folder}/{year}VAERSDATA.csv', index=False)
+        # one row per report with 1 to 5 symptoms
+        count = rng.integers(1, 6, rows)
+        symp = pd.DataFrame({'VAERS_ID': ids})
+        for i in range(5):
+            symp[f'SYMPTOM{i + 1}'] = np.where(count > i, rng.choice(SYMPTOMS, rows, p=symptom_p), None)
+            symp[f'SYMPTOMVERSION{i + 1}'] = np.where(count > i, 26.0, np.nan)
+        symp.to_csv(f'{folder}/{year}VAERSSYMPTOMS.csv', index=False)
+        # one vaccine per report, a second one for 10% of the reports
+        year_codes = [c for c in codes if year >= 2020 or not c.startswith('COVID')]
+        vax_ids = np.concatenate([ids, ids[rng.random(rows) < 0.1]])
+        vax_type = rng.choice(year_codes, len(vax_ids))
+        pd.DataFrame({'VAERS_ID': vax_ids, 'VAX_TYPE': vax_type, 'VAX_MANU': rng.choice(['PFIZER\\BIONTECH', 'MODERNA', 'MERCK & CO. INC.'], len(vax_ids)),
+                      'VAX_LOT': 'LOT1', 'VAX_DOSE_SERIES': '1', 'VAX_ROUTE': 'IM', 'VAX_SITE': 'LA',
+                      'VAX_NAME': vax_type}).sort_values('VAERS_ID').to_csv(f'{folder}/{year}VAERSVAX.csv', index=False)
+
+
+
+########################## Gemini stand-in ###########################
+class FakeResponse:
+    '''
+    Response with .text and .usage_metadata, iterable in chunks when streamed.
+    '''
+    def __init__(self, text: str, contents, chunks: int = 1, chunk_latency: float = 0):
+        self.text = text
+        self.chunk_latency = chunk_latency
+        step = max(1, -(-len(text) // chunks))
+        self._chunks = [text[i:i + step] for i in range(0, len(text), step)]
+        # about 4 characters per token
+        self.usage_metadata = types.SimpleNamespace(prompt_token_count=len(str(contents)) // 4,
+                                                    candidates_token_count=len(text) // 4)
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            time.sleep(self.chunk_latency)
+            yield types.SimpleNamespace(text=chunk)
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self.chunk_latency)
+            yield types.SimpleNamespace(text=chunk)
+
+
+class FakeChat:
+    def __init__(self, bot):
+        self.bot = bot
+        self.history = []
+
+    def send_message(self, content, stream=False, **kwargs):
+        time.sleep(self.bot.latency)    # time to first token
+        self.history.append(content)
+        return FakeResponse(ANSWER, content, self.bot.chunks, self.bot.chunk_latency)
+
+    async def send_message_async(self, content, stream=False, **kwargs):
+        await asyncio.sleep(self.bot.latency)
+        self.history.append(content)
+        return FakeResponse(ANSWER, content, self.bot.chunks, self.bot.chunk_latency)
+
+    def rewind(self):
+        self.history.pop()
+
+
+class FakeModel:
+    '''
+    Stand-in for genai.GenerativeModel: waits latency seconds per call, then answers reply(contents).
+    '''
+    def __init__(self, reply, latency: float = 0, chunks: int = 8, chunk_latency: float = 0):
+        self.reply = reply
+        self.latency = latency
+        self.chunks = chunks
+        self.chunk_latency = chunk_latency
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        return FakeResponse(self.reply(contents), contents)
+
+    def start_chat(self, history=None):
+        return FakeChat(self)
+
+
+def fake_bots(main, latency: float) -> dict:
+    '''
+    Output: {bot name: FakeModel} with the canned output of each planning bot for the questions in QUESTIONS
+    '''
+    queries = {text: query for text, query in QUESTIONS}
+    actions = {'Please perform the task for: ' + str(query): json.dumps(main.query_translate(query))
+               for query in queries.values() if query['relevant']}
+    return {'query_extract': FakeModel(lambda contents: json.dumps(queries.get(contents[0], {'relevant': False})), latency),
+            'input_extract': FakeModel(lambda contents: json.dumps(queries[contents[0]]) if queries.get(contents[0], {}).get('relevant') else 'None', latency),
+            'data_assistant': FakeModel(lambda contents: actions.get(contents[0], 'None'), latency)}
+
+
+
+########################## Measurements ###########################
+def peak_rss_mb() -> float:
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss    # kB on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def reset_state(main) -> None:
+    # empty query caches and metrics, so each scenario starts cold
+    for cache in main.query_caches.values():
+        cache.clear()
+        cache.hits = cache.misses = 0
+    main.metrics = main.Metrics()
+    main.sessions = main.SessionStore()
+
+
+def turn(main, text: str, session: str) -> dict:
+    '''
+    Input: question, session name
+    Output: {'seconds': end to end, 'first_token': seconds until the first answer chunk}
+    '''
+    start = time.perf_counter()
+    first = None
+    for output in main.response({'text': text, 'files': []}, [], types.SimpleNamespace(session_hash=session)):
+        if first is None and not output.startswith('*Data assistant'):
+            first = time.perf_counter() - start
+    return {'seconds': time.perf_counter() - start, 'first_token': first}
+
+
+async def turn_async(main, text: str, session: str) -> dict:
+    start = time.perf_counter()
+    first = None
+    async for output in main.response_async({'text': text, 'files': []}, [], types.SimpleNamespace(session_hash=session)):
+        if first is None and not output.startswith('*Data assistant'):
+            first = time.perf_counter() - start
+    return {'seconds': time.perf_counter() - start, 'first_token': first}
+
+
+def replay(main, questions: list, concurrency: int, use_async: bool = False) -> dict:
+    '''
+    Input: questions, number of simulated users (one session each)
+    Output: latency percentiles, throughput, per-stage timings and cache stats of the run
+    '''
+    reset_state(main)
+    sessions = [f'bench-{i % concurrency}' for i in range(len(questions))]
+    start = time.perf_counter()
+    if use_async:
+        async def run():
+            limit = asyncio.Semaphore(concurrency)
+            async def limited(text, session):
+                async with limit:
+                    return await turn_async(main, text, session)
+            return await asyncio.gather(*[limited(text, session) for text, session in zip(questions, sessions)])
+        results = asyncio.run(run())
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda args: turn(main, *args), zip(questions, sessions)))
+    wall = time.perf_counter() - start
+    seconds = np.array([r['seconds'] for r in results])
+    first = np.array([r['first_token'] for r in results if r['first_token'] is not None])
+    stages = {}
+    for name, histogram in main.metrics.snapshot()['histograms'].items():
+        if name.startswith('vaers_stage_seconds'):
+            stages[name.split('"')[1]] = {'count': histogram['count'], 'mean_ms': 1000 * histogram['sum'] / histogram['count']}
+    return {'turns': len(results), 'concurrency': concurrency, 'wall_s': wall, 'throughput_per_s': len(results) / wall,
+            **{f'p{p}_s': float(np.percentile(seconds, p)) for p in (50, 95, 99)},
+            'first_token_p50_s': float(np.percentile(first, 50)) if len(first) else None,
+            'stages': stages, 'caches': main.cache_stats(), 'peak_rss_mb': peak_rss_mb()}
+
+
+def print_report(name: str, result: dict) -> None:
+    print(f'\n{name}: {result["turns"]} turns, {result["concurrency"]} concurrent, {result["wall_s"]:.2f} s, '
+          f'{result["throughput_per_s"]:.2f} turns/s, peak RSS {result["peak_rss_mb"]:.0f} MB')
+    print(f'  latency p50 {result["p50_s"]:.3f} s  p95 {result["p95_s"]:.3f} s  p99 {result["p99_s"]:.3f} s'
+          + (f'  first token p50 {result["first_token_p50_s"]:.3f} s' if result['first_token_p50_s'] is not None else ''))
+    for stage, timing in sorted(result['stages'].items(), key=lambda item: -item[1]['count'] * item[1]['mean_ms']):
+        print(f'  {stage:<12} {timing["count"]:>6} x {timing["mean_ms"]:9.2f} ms')
+    print('  caches ' + ', '.join(f'{name} {s["hits"]}/{s["hits"] + s["misses"]} hits' for name, s in result['caches'].items()))
+
+
+
+########################## Run ###########################
+def main_benchmark(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', type=int, default=20000, help='reports per year in the synthetic files')
+    parser.add_argument('--years', default='2014-2023', help='first-last year')
+    parser.add_argument('--data', help='directory of the synthetic files, reused if it exists (default: temporary)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per model call')
+    parser.add_argument('--chunk-latency', type=float, default=0.0, help='seconds between streamed answer chunks')
+    parser.add_argument('--repeat', type=int, default=3, help='times the corpus is replayed per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='simulated users in the concurrent scenario')
+    parser.add_argument('--planning', choices=['single', 'legacy'], default='single')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='replay through response_async')
+    parser.add_argument('--cube', action='store_true', help='build the aggregate cube before replaying')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args(argv)
+    first_year, last_year = map(int, args.years.split('-'))
+    years = range(first_year, last_year + 1)
+    os.environ['VAERS_PLANNING'] = args.planning
+    results = {'startup': {}}
+    startup = results['startup']
+    log = io.StringIO()    # prints of main, kept out of the report
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        import main
+    startup['import_s'] = time.perf_counter() - start
+    import atexit
+    atexit.unregister(main.save_query_caches)    # do not overwrite the query caches of the app
+
+    root = args.data or tempfile.mkdtemp(prefix='vaers-bench-')
+    start = time.perf_counter()
+    if not os.path.exists(f'{root}/{last_year}VAERSData'):
+        make_dataset(root, years, args.rows, list(main.vaccine_code))
+    startup['generate_s'] = time.perf_counter() - start
+
+    # point the app at the synthetic files (dataset_V is bound as default argument, so it is changed in place)
+    ds = main.dataset_V
+    ds.years, ds.data_dir, ds.cache_dir = list(years), root, f'{root}/cache'
+    ds._frames.clear()
+    ds._checked.clear()
+    main.CACHE_DIR = ds.cache_dir
+    main.CUBE_PATH, main.CUBE_SYMPTOM_PATH = f'{ds.cache_dir}/cube.parquet', f'{ds.cache_dir}/cube_symp.parquet'
+    main.QUERY_CACHE_PATH = f'{ds.cache_dir}/query_cache.pkl'
+    main.year_indexes.clear()
+    main.symptom_indexes.clear()
+    main._cube.clear()
+
+    # Gemini stand-in
+    bots = fake_bots(main, args.latency)
+    main.static_model = lambda name, prompt: bots[name]
+    main.model = FakeModel(lambda contents: '{}', args.latency, chunk_latency=args.chunk_latency)
+
+    with contextlib.redirect_stdout(log):
+        for name, step in [('columnar_cache_s', lambda: main.build_cache(ds)),
+                           ('prompts_s', lambda: (main.input_extract_prompt(), main.data_assistant_prompt())),
+                           ('index_s', lambda: main.symptom_index(ds)),    # builds the year indexes too
+                           *([('cube_s', lambda: main.build_cube(ds))] if args.cube else [])]:
+            start = time.perf_counter()
+            step()
+            startup[name] = time.perf_counter() - start
+    startup['peak_rss_mb'] = peak_rss_mb()
+    startup['dataset_mb'] = sum(ds.memory_usage().values()) / 1024**2
+    print(f'Startup ({args.rows} reports x {len(years)} years, {args.planning} planning): '
+          + ', '.join(f'{k} {v:.2f}' for k, v in startup.items()))
+
+    questions = [text for text, _ in QUESTIONS] * args.repeat
+    with contextlib.redirect_stdout(log):
+        results['serial'] = replay(main, questions, 1, args.use_async)
+        results['concurrent'] = replay(main, questions, args.concurrency, args.use_async)
+    print_report('Serial', results['serial'])
+    print_report('Concurrent', results['concurrent'])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.data:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    main_benchmark()
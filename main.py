@@ -3,48 +3,1162 @@ import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import os
 import PIL.Image
+import PIL.ImageOps
 import time
 import pandas as pd
+import numpy as np
 import json
+import typing
+import pickle
+import atexit
+import datetime
+import asyncio
+import re
+import bisect
+import logging
+import contextlib
+import contextvars
+import functools
+import http.server
+import urllib.request
+import hashlib
+import io
+import sys
+import threading
+import collections.abc
+import concurrent.futures
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:    # columnar cache is optional, fall back to reading the csv files
+    pyarrow = None
 
 ########################## Load data ###########################
 # Load vaccine code
-with open('./vaccine_code.txt') as f:
-    vaccine_code = f.read()
-
-vaccine_code = json.loads(vaccine_code)   #convert to dict
+VACCINE_CODE_PATH = './vaccine_codes_modified.txt'    # VAX_TYPE codes and descriptions
+vaccine_code = pd.read_csv(VACCINE_CODE_PATH, skipinitialspace=True, dtype=str)
+vaccine_code = dict(zip(vaccine_code['Vaccine Code'].str.strip(), vaccine_code['Vaccine Description'].str.strip()))   #convert to dict
 print('------------------------- vaccine code loaded -------------------------')
 
 
 
 # Load vaccine data
-dataset_V = {}    # a dict of dataframes
-for year in range(2014, 2024):
-    dataset_V[f'{year}data'] = pd.read_csv(f'./data/{year}VAERSData/{year}VAERSDATA.csv', encoding='latin1')
-    dataset_V[f'{year}symp'] = pd.read_csv(f'./data/{year}VAERSData/{year}VAERSSYMPTOMS.csv', encoding='latin1')
-    dataset_V[f'{year}vax'] = pd.read_csv(f'./data/{year}VAERSData/{year}VAERSVAX.csv', encoding='latin1')
+DATA_DIR = './data'
+CACHE_DIR = './data/cache'     # columnar copies of the csv files
+CACHE_MAX_BYTES = int(os.environ.get('VAERS_CACHE_MAX_BYTES', 2 * 1024**3))   # memory budget for loaded frames
+VAERS_FILES = {'data': 'VAERSDATA', 'symp': 'VAERSSYMPTOMS', 'vax': 'VAERSVAX'}
+# low-cardinality columns -> name of their vocabulary, shared by all years (and by SYMPTOM1..5)
+ENCODED_COLUMNS = {**{f'SYMPTOM{i}': 'SYMPTOM' for i in range(1, 6)}, **{f'SYMPTOMVERSION{i}': 'SYMPTOMVERSION' for i in range(1, 6)},
+                   **{column: column for column in ['SEX', 'STATE', 'VAX_TYPE', 'VAX_MANU', 'VAX_ROUTE', 'VAX_SITE', 'VAX_DOSE_SERIES',
+                                                    'VAX_NAME', 'V_ADMINBY', 'V_FUNDBY', 'SPLTTYPE', 'DIED', 'L_THREAT', 'ER_VISIT',
+                                                    'HOSPITAL', 'X_STAY', 'DISABLE', 'RECOVD', 'BIRTH_DEFECT', 'OFC_VISIT', 'ER_ED_VISIT',
+                                                    'RECVDATE', 'RPT_DATE', 'DATEDIED', 'VAX_DATE', 'ONSET_DATE', 'TODAYS_DATE']}}
+NARROW_TYPES = {'VAERS_ID': 'int32', 'AGE_YRS': 'float32', 'CAGE_YR': 'float32', 'CAGE_MO': 'float32',
+                'NUMDAYS': 'float32', 'HOSPDAYS': 'float32'}    # ages keep their fractions (e.g. 0.5 years)
+FREE_TEXT_COLUMNS = ['SYMPTOM_TEXT', 'LAB_DATA', 'OTHER_MEDS', 'CUR_ILL', 'HISTORY', 'PRIOR_VAX', 'ALLERGIES']
+LOAD_FREE_TEXT = os.environ.get('VAERS_FREE_TEXT', '0') == '1'    # load free text with the whole file, else only when asked for
+
+
+class LazyDataset(collections.abc.Mapping):
+    '''
+    Dict of dataframes with keys '{year}data', '{year}symp', '{year}vax'.
+    Frames (and only the requested columns) are loaded on first access from a Parquet copy of the csv,
+    and kept in a LRU bounded by max_bytes. The Parquet copy is rebuilt when the csv mtime changes,
+    or, if rows were only appended to the csv, extended by these rows (as is the loaded frame).
+    Frames are held compactly: ENCODED_COLUMNS as categoricals of shared vocabularies (which only grow, so codes stay valid),
+    NARROW_TYPES as narrow numbers, and FREE_TEXT_COLUMNS only if asked for by name (or with free_text).
+    '''
+    def __init__(self, years, data_dir=DATA_DIR, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, free_text=LOAD_FREE_TEXT):
+        self.years = list(years)
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.free_text = free_text
+        self.vocabularies = {}                      # vocabulary name -> categories
+        self._frames = collections.OrderedDict()    # name -> (csv mtime, dataframe, bytes)
+        self._lock = threading.Lock()               # guards self._frames
+        self._file_locks = collections.defaultdict(threading.RLock)  # one loader or converter at a time per file
+        self._checked = {}                          # name -> csv mtime of the verified Parquet copy
+        self._deltas = {}                           # name -> (old csv mtime, new csv mtime, appended rows) for loaded frames
+        self.incoming = set()                       # years being ingested, readable but not yet in self.years
+
+    def __getitem__(self, name):
+        return self.load(name)
+
+    def __iter__(self):
+        return iter([f'{year}{kind}' for year in self.years for kind in VAERS_FILES])
+
+    def __len__(self):
+        return len(self.years) * len(VAERS_FILES)
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name[:4].isdigit() and name[4:] in VAERS_FILES and \
+            (int(name[:4]) in self.years or int(name[:4]) in self.incoming)
+
+    def source_path(self, name: str) -> str:
+        return f'{self.data_dir}/{name[:4]}VAERSData/{name[:4]}{VAERS_FILES[name[4:]]}.csv'
+
+    def cache_path(self, name: str) -> str:
+        return f'{self.cache_dir}/{name}.parquet'
+
+    def source_mtime(self, name: str):
+        try:
+            return os.path.getmtime(self.source_path(name))
+        except FileNotFoundError:
+            return None     # csv not shipped, use the cached copy if there is one
+
+    def _read_csv(self, name: str, columns=None) -> pd.DataFrame:
+        return pd.read_csv(self.source_path(name), encoding='latin1', usecols=columns, low_memory=False)
+
+    def ensure_cached(self, name: str) -> bool:
+        '''
+        Input: file name
+        Output: True if an up-to-date Parquet copy exists (converting the csv if needed)
+        '''
+        if pyarrow is None:
+            return False
+        mtime = self.source_mtime(name)
+        if name in self._checked and self._checked[name] == mtime:
+            return True
+        with self.file_lock(name):    # the first caller converts, the others wait and find the copy up to date
+            mtime = self.source_mtime(name)
+            path = self.cache_path(name)
+            if name in self._checked and self._checked[name] == mtime:
+                return True
+            if os.path.exists(path):
+                metadata = pq.read_schema(path).metadata or {}
+                if mtime is None or metadata.get(b'vaers_source_mtime') == repr(mtime).encode():
+                    self._checked[name] = mtime
+                    return True
+                if self._append(name, metadata, mtime):
+                    return True
+            if mtime is None:
+                raise KeyError(name)
+            # convert csv -> parquet, the source mtime and size are stored in the file metadata
+            size = os.path.getsize(self.source_path(name))
+            table = pyarrow.Table.from_pandas(self._read_csv(name), preserve_index=False)
+            if os.path.getsize(self.source_path(name)) != size:
+                size = None    # written to while read, the next change is converted in full
+            self._write_cache(name, table, mtime, size)
+            print(f'Cached {name} to {path}.')
+            return True
+
+    def file_lock(self, name: str) -> threading.RLock:
+        with self._lock:
+            return self._file_locks[name]
+
+    def _write_cache(self, name: str, table, mtime: float, size: int = None):
+        metadata = {b'vaers_source_mtime': repr(mtime).encode()}
+        if size:
+            metadata.update({b'vaers_source_size': str(size).encode(), b'vaers_source_tail': self._tail(name, size)})
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+        path = self.cache_path(name)
+        tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'    # unique, other processes may convert too
+        os.makedirs(self.cache_dir, exist_ok=True)
+        pq.write_table(table, tmp)
+        os.replace(tmp, path)
+        self._checked[name] = mtime
+
+    def _tail(self, name: str, size: int) -> bytes:
+        # digest of the csv bytes before size, to recognise rows appended after them
+        with open(self.source_path(name), 'rb') as f:
+            f.seek(max(0, size - 4096))
+            return hashlib.sha1(f.read(size - max(0, size - 4096))).hexdigest().encode()
+
+    def _append(self, name: str, metadata: dict, mtime: float) -> bool:
+        '''
+        Input: file name, metadata of its Parquet copy, csv mtime
+        Output: True if rows were only appended to the csv, these rows are then added to the Parquet copy
+        '''
+        size = int(metadata.get(b'vaers_source_size', 0))
+        try:
+            if not size or os.path.getsize(self.source_path(name)) <= size or self._tail(name, size) != metadata.get(b'vaers_source_tail'):
+                return False
+            with open(self.source_path(name), 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    return False
+                data = f.read()
+            data = data[:data.rfind(b'\n') + 1]    # complete lines only
+            if not data:
+                return False
+            old = pq.read_table(self.cache_path(name))
+            delta = pd.read_csv(io.BytesIO(data), names=old.schema.names, header=None, encoding='latin1', low_memory=False)
+            table = pyarrow.concat_tables([old.replace_schema_metadata(None),
+                                           pyarrow.Table.from_pandas(delta, preserve_index=False).replace_schema_metadata(None)],
+                                          promote_options='permissive')
+        except Exception as e:    # e.g. a column changed type, convert the whole csv
+            print(f'Appending to {name} failed:', e)
+            return False
+        self._write_cache(name, table, mtime, size + len(data))
+        with self._lock:
+            if name in self._frames:    # kept to extend the loaded frame
+                self._deltas[name] = (float(metadata[b'vaers_source_mtime']), mtime, delta)
+        print(f'Appended {len(delta)} rows to {self.cache_path(name)}.')
+        return True
+
+    def is_stale(self, name: str) -> bool:
+        '''
+        Output: True if the csv changed since its Parquet copy was made or its frame was loaded
+        '''
+        mtime = self.source_mtime(name)
+        if mtime is None:
+            return False
+        with self._lock:
+            entry = self._frames.get(name)
+        if entry is not None and entry[0] != mtime:
+            return True
+        if pyarrow is None or self._checked.get(name) == mtime:
+            return False
+        path = self.cache_path(name)
+        return not os.path.exists(path) or (pq.read_schema(path).metadata or {}).get(b'vaers_source_mtime') != repr(mtime).encode()
+
+    def refresh(self, name: str):
+        # bring the Parquet copy and the loaded frame (same columns) up to date with the csv
+        self.ensure_cached(name)
+        with self._lock:
+            entry = self._frames.get(name)
+        if entry is not None:
+            self.load(name, list(entry[1].columns))
+
+    def columns(self, name: str) -> list:
+        if self.ensure_cached(name):
+            return pq.read_schema(self.cache_path(name)).names
+        return list(pd.read_csv(self.source_path(name), encoding='latin1', nrows=0).columns)
+
+    def head(self, name: str, n: int = 5) -> pd.DataFrame:
+        '''
+        Input: file name
+        Output: first n rows, without loading the whole file
+        '''
+        if self.ensure_cached(name):
+            return next(pq.ParquetFile(self.cache_path(name)).iter_batches(batch_size=n)).to_pandas()
+        return pd.read_csv(self.source_path(name), encoding='latin1', nrows=n)
+
+    def load(self, name: str, columns=None) -> pd.DataFrame:
+        '''
+        Input: file name, optional list of columns
+        Output: dataframe with the requested columns (all columns if None)
+        '''
+        return self.load_version(name, columns)[1]
+
+    def load_version(self, name: str, columns=None) -> tuple:
+        '''
+        Input: file name, optional list of columns
+        Output: (csv mtime the frame was loaded from, dataframe), see load
+        '''
+        if name not in self:
+            raise KeyError(name)
+        mtime = self.source_mtime(name)
+        with self.file_lock(name):
+            with self._lock:
+                entry = self._frames.get(name)
+            if entry is not None and entry[0] != mtime:   # csv changed since loaded
+                entry = self._extend(name, entry, mtime)
+            df = entry[1] if entry is not None else None
+            if columns is None:
+                wanted = [c for c in self.columns(name) if self.free_text or c not in FREE_TEXT_COLUMNS]
+            else:
+                wanted = list(columns)
+            missing = [c for c in wanted if df is None or c not in df.columns]
+            if missing:
+                new = self.encode(self.read(name, missing))
+                df = new if df is None else pd.concat([df, new], axis=1)
+                with self._lock:
+                    self._frames[name] = (mtime, df, int(df.memory_usage(deep=True).sum()))
+                    self._evict(keep=name)
+            with self._lock:
+                if name in self._frames:
+                    self._frames.move_to_end(name)
+        return mtime, df if list(df.columns) == wanted else df[wanted]
+
+    def read(self, name: str, columns=None) -> pd.DataFrame:
+        '''
+        Input: file name, optional list of columns
+        Output: dataframe as stored, not encoded nor kept in memory
+        '''
+        if self.ensure_cached(name):
+            return pd.read_parquet(self.cache_path(name), columns=columns)
+        return self._read_csv(name, columns)
+
+    def encode(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Input: dataframe as read
+        Output: the same with ENCODED_COLUMNS as categoricals of the shared vocabularies, NARROW_TYPES narrowed
+        '''
+        for column in df.columns:
+            vocabulary = ENCODED_COLUMNS.get(column)
+            if vocabulary is not None:
+                values = df[column]
+                uniques = pd.Index(values.dropna().unique())
+                with self._lock:
+                    categories = self.vocabularies.get(vocabulary, uniques[:0])
+                    new = uniques.difference(categories)
+                    if len(new):    # new values are appended, codes of frames already loaded stay valid
+                        categories = self.vocabularies[vocabulary] = categories.append(new)
+                df[column] = pd.Categorical(values, categories=categories)
+            elif column in NARROW_TYPES and pd.api.types.is_numeric_dtype(df[column]):
+                dtype = NARROW_TYPES[column]
+                if dtype == 'int32' and (df[column].hasnans or df[column].max() >= 2**31):
+                    continue
+                df[column] = df[column].astype(dtype)
+        return df
+
+    def align(self, frames: list) -> list:
+        '''
+        Input: frames of the same file kind from several years
+        Output: the frames with the current vocabularies, so that they can be concatenated as categoricals
+        '''
+        aligned = []
+        for df in frames:
+            for column in df.columns:
+                vocabulary = ENCODED_COLUMNS.get(column)
+                if vocabulary in self.vocabularies and isinstance(df[column].dtype, pd.CategoricalDtype) \
+                        and len(df[column].cat.categories) < len(self.vocabularies[vocabulary]):
+                    df = df.assign(**{column: df[column].cat.set_categories(self.vocabularies[vocabulary])})
+            aligned.append(df)
+        return aligned
+
+    def _extend(self, name: str, entry: tuple, mtime: float):
+        # loaded frame with the rows appended to the csv since, None if the csv changed otherwise
+        self.ensure_cached(name)
+        with self._lock:
+            self._frames.pop(name, None)
+            delta = self._deltas.pop(name, None)
+        if delta is None or delta[:2] != (entry[0], mtime):
+            return None
+        df = entry[1]
+        new = self.encode(delta[2][list(df.columns)].copy())
+        df = pd.concat(self.align([df, new]), ignore_index=True)
+        entry = (mtime, df, int(df.memory_usage(deep=True).sum()))
+        with self._lock:
+            self._frames[name] = entry
+        return entry
+
+    def _evict(self, keep: str):
+        # drop least recently used frames until under the memory budget
+        total = sum(entry[2] for entry in self._frames.values())
+        for name in list(self._frames):
+            if total <= self.max_bytes:
+                break
+            if name != keep:
+                total -= self._frames.pop(name)[2]
+
+    def memory_usage(self) -> dict:
+        with self._lock:
+            return {name: entry[2] for name, entry in self._frames.items()}
+
+
+def build_cache(ds) -> None:
+    '''
+    Convert all available csv files to the columnar cache (python main.py build-cache)
+    '''
+    for name in ds:
+        try:
+            ds.ensure_cached(name)
+        except (KeyError, FileNotFoundError):
+            print(f'Skipped {name}: csv not found.')
+
+
+def memory_report(ds) -> pd.DataFrame:
+    '''
+    Memory of each frame as stored (plain columns, all of them) and as loaded (encoded, free text left out)
+    (python main.py memory-report)
+    '''
+    rows = []
+    for name in ds:
+        try:
+            plain = ds.read(name)
+        except (KeyError, FileNotFoundError):
+            continue
+        text = [c for c in FREE_TEXT_COLUMNS if c in plain.columns]
+        loaded = ds.load(name)
+        rows.append({'FRAME': name, 'ROWS': len(plain),
+                     'PLAIN_MB': plain.memory_usage(deep=True).sum() / 1024**2,
+                     'FREE_TEXT_MB': plain[text].memory_usage(deep=True, index=False).sum() / 1024**2,
+                     'LOADED_MB': loaded.memory_usage(deep=True).sum() / 1024**2})
+    report = pd.DataFrame(rows, columns=['FRAME', 'ROWS', 'PLAIN_MB', 'FREE_TEXT_MB', 'LOADED_MB'])
+    report.loc[len(report)] = ['total', report['ROWS'].sum(), *report[['PLAIN_MB', 'FREE_TEXT_MB', 'LOADED_MB']].sum()]
+    report['SAVED_%'] = (100 * (1 - report['LOADED_MB'] / report['PLAIN_MB'])).round(1)
+    print(report.round(2).to_string(index=False))
+    return report
+
+
+def discover_years(data_dir: str = DATA_DIR, cache_dir: str = CACHE_DIR) -> list:
+    '''
+    Output: sorted years with a {year}VAERSData directory, or with a Parquet copy of its files
+    '''
+    years = set()
+    for folder, pattern in [(data_dir, r'(\d{4})VAERSData'), (cache_dir, r'(\d{4})(data|symp|vax)\.parquet')]:
+        try:
+            entries = os.listdir(folder)
+        except FileNotFoundError:
+            continue
+        years.update(int(match.group(1)) for match in map(re.compile(pattern).fullmatch, entries) if match)
+    return sorted(years)
+
+
+dataset_V = LazyDataset(discover_years() or range(2014, 2024))    # a dict of dataframes, loaded on demand
+
+
+def year_span(ds=dataset_V) -> tuple:
+    # first and last year of the data, as advertised in the prompts
+    return min(ds.years), max(ds.years)
 print('------------------------- vaccine data loaded -------------------------')
 
 
 
+# Index vaccine data
+SYMPTOM_COLUMNS = ['SYMPTOM1', 'SYMPTOM2', 'SYMPTOM3', 'SYMPTOM4', 'SYMPTOM5']
+ANY_SYMPTOM = 'SYMPTOM'    # filter column in '{year}symp' matching any of SYMPTOM1..5
+INDEX_COLUMNS = {'data': ['SEX', 'AGE_YRS'],
+                 'symp': SYMPTOM_COLUMNS,
+                 'vax': ['VAX_TYPE']}    # hot filter columns with an inverted index
+
+
+class YearIndex:
+    '''
+    Join index over the data/symp/vax files of one year.
+    VAERS_ID -> row positions in each file (ids sorted once, looked up by binary search),
+    and inverted indexes (kind, column) -> {trait: sorted unique array of VAERS_ID} for INDEX_COLUMNS.
+    AGE_YRS is indexed by whole years, and ANY_SYMPTOM merges the postings of SYMPTOM1..5.
+    '''
+    def __init__(self, year: int, ds):
+        self.year = year
+        self.mtimes = {}        # kind -> csv mtime the index was built from
+        self._order = {}        # kind -> row positions sorted by VAERS_ID
+        self._sorted_ids = {}   # kind -> VAERS_ID sorted
+        self.postings = {}      # (kind, column) -> {trait: VAERS_ID array}
+        for kind, columns in INDEX_COLUMNS.items():
+            name = f'{year}{kind}'
+            try:
+                columns = [c for c in columns if c in ds.columns(name)]
+                version, df = ds.load_version(name, ['VAERS_ID', *columns])
+            except (KeyError, FileNotFoundError):
+                continue    # file not available for this year
+            self.mtimes[kind] = version    # row positions are only valid for frames of this version
+            ids = df['VAERS_ID'].to_numpy()
+            order = np.argsort(ids, kind='stable')
+            self._order[kind] = order
+            self._sorted_ids[kind] = ids[order]
+            for column in columns:
+                values = np.floor(df[column]) if column == 'AGE_YRS' else df[column]
+                groups = values.groupby(values, sort=False, observed=True).indices    # trait -> row positions
+                self.postings[(kind, column)] = {trait: np.unique(ids[rows]) for trait, rows in groups.items()}
+            if kind == 'symp':
+                merged = collections.defaultdict(list)
+                for column in columns:
+                    for trait, found in self.postings[(kind, column)].items():
+                        merged[trait].append(found)
+                self.postings[(kind, ANY_SYMPTOM)] = {trait: np.unique(np.concatenate(found)) for trait, found in merged.items()}
+
+    def is_current(self, ds) -> bool:
+        return all(ds.source_mtime(f'{self.year}{kind}') == mtime for kind, mtime in self.mtimes.items())
+
+    def lookup(self, kind: str, column: str, traits: list):
+        '''
+        Input: file kind, column, list of traits
+        Output: sorted VAERS_ID array having any of the traits, None if the column is not indexed
+        '''
+        postings = self.postings.get((kind, column))
+        if postings is None:
+            return None
+        if column == 'AGE_YRS':
+            traits = [np.floor(float(t)) for t in traits if str(t).replace('.', '', 1).isdigit()]
+        found = [postings[t] for t in traits if t in postings]
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=self._sorted_ids[kind].dtype)
+
+    def resolve(self, kind: str, filter: dict):
+        '''
+        Input: file kind, filter {column: [traits]}
+        Output: sorted VAERS_ID array matching all columns, None if a column is not indexed
+        '''
+        IDs = None
+        for column, traits in filter.items():
+            found = self.lookup(kind, column, traits)
+            if found is None:
+                return None
+            IDs = found if IDs is None else np.intersect1d(IDs, found, assume_unique=True)
+        return IDs
+
+    def rows(self, kind: str, IDs) -> np.ndarray:
+        '''
+        Input: file kind, VAERS_ID array
+        Output: sorted row positions of these IDs in the file
+        '''
+        sorted_ids = self._sorted_ids[kind]
+        IDs = np.unique(np.asarray(IDs, dtype=sorted_ids.dtype))
+        left = np.searchsorted(sorted_ids, IDs, 'left')
+        counts = np.searchsorted(sorted_ids, IDs, 'right') - left
+        # expand each [left, right) range into positions
+        positions = np.repeat(left - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.sort(self._order[kind][positions])
+
+
+year_indexes = {}    # year -> YearIndex
+_index_lock = threading.Lock()                              # guards year_indexes and _index_locks
+_index_locks = collections.defaultdict(threading.Lock)      # one build at a time per year, years built in parallel
+
+def year_index(year: int, ds=dataset_V) -> YearIndex:
+    '''
+    Input: year
+    Output: join index for the year, built on first use and rebuilt if a source csv changed
+    '''
+    with _index_lock:
+        lock = _index_locks[year]
+    with lock:
+        index = year_indexes.get(year)
+        if index is None or not index.is_current(ds):
+            index = YearIndex(year, ds)
+            with _index_lock:
+                year_indexes[year] = index
+    return index
+
+
+# symptom mentions in plain words -> MedDRA terms (only the terms found in the reports are used)
+SYMPTOM_SYNONYMS = {
+    'sick': ['Nausea', 'Vomiting', 'Malaise'], 'nauseous': ['Nausea'], 'throwing up': ['Vomiting'], 'vomit': ['Vomiting'],
+    'fever': ['Pyrexia', 'Body temperature increased'], 'temperature': ['Pyrexia', 'Body temperature increased'],
+    'tired': ['Fatigue', 'Asthenia'], 'tiredness': ['Fatigue', 'Asthenia'], 'exhaustion': ['Fatigue'], 'weakness': ['Asthenia', 'Muscular weakness'],
+    'dizzy': ['Dizziness'], 'faint': ['Syncope', 'Presyncope', 'Loss of consciousness'], 'fainting': ['Syncope', 'Presyncope', 'Loss of consciousness'],
+    'sore arm': ['Injection site pain', 'Pain in extremity'], 'arm pain': ['Injection site pain', 'Pain in extremity'],
+    'aches': ['Myalgia', 'Pain'], 'muscle pain': ['Myalgia'], 'joint pain': ['Arthralgia'], 'body aches': ['Myalgia', 'Pain'],
+    'allergy': ['Hypersensitivity', 'Anaphylactic reaction', 'Urticaria'], 'allergic reaction': ['Hypersensitivity', 'Anaphylactic reaction', 'Urticaria'],
+    'anaphylaxis': ['Anaphylactic reaction', 'Anaphylactic shock'], 'hives': ['Urticaria'], 'itching': ['Pruritus'], 'itchy': ['Pruritus'],
+    'redness': ['Erythema', 'Injection site erythema'], 'swelling': ['Swelling', 'Injection site swelling'],
+    'breathless': ['Dyspnoea'], 'shortness of breath': ['Dyspnoea'], 'difficulty breathing': ['Dyspnoea'],
+    'heart inflammation': ['Myocarditis', 'Pericarditis'], 'palpitations': ['Palpitations', 'Heart rate increased'],
+    'blood clot': ['Thrombosis', 'Deep vein thrombosis', 'Pulmonary embolism'], 'clots': ['Thrombosis', 'Deep vein thrombosis', 'Pulmonary embolism'],
+    'stroke': ['Cerebrovascular accident'], 'heart attack': ['Myocardial infarction'],
+    'seizure': ['Seizure', 'Febrile convulsion'], 'fits': ['Seizure', 'Febrile convulsion'], 'convulsions': ['Seizure', 'Febrile convulsion'],
+    'diarrhea': ['Diarrhoea'], 'stomach ache': ['Abdominal pain', 'Abdominal pain upper'],
+    'bells palsy': ['Facial paralysis'], "bell's palsy": ['Facial paralysis'], 'gbs': ['Guillain-Barre syndrome'],
+    'guillain barre': ['Guillain-Barre syndrome'], 'miscarriage': ['Abortion spontaneous'], 'shingles': ['Herpes zoster'],
+    'death': ['Death'], 'died': ['Death'], 'dead': ['Death'], 'crying': ['Crying'], 'fussy': ['Irritability'],
+    'feeling sick': ['Nausea', 'Malaise'], 'swollen arm': ['Peripheral swelling', 'Injection site swelling'],
+}
+SYMPTOM_PREFIX_MIN = 4       # shortest mention expanded to all terms starting with it
+SYMPTOM_FUZZY_LENGTH = 5     # shortest word corrected as a near-miss spelling (1 edit, 2 edits from 8 letters)
+SYMPTOM_MEMO_SIZE = 4096     # resolved mentions kept per index (LRU)
+
+
+def _trigrams(term: str) -> set:
+    padded = f'  {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _singular(word: str) -> str:
+    # 'clots' -> 'clot', 'allergies' -> 'allergy', 'rashes' -> 'rash'; 'dizziness', 'sinus', 'arthritis' unchanged
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('shes', 'xes', 'sses', 'zes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    # edits (insert, delete, substitute, swap adjacent letters) from a to b, limit + 1 once above limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+class SymptomIndex:
+    '''
+    Vocabulary of the symptom terms of all years, with
+    term -> {year: sorted VAERS_ID array} (the ANY_SYMPTOM postings of the YearIndex of each year),
+    a sorted lower-case vocabulary for prefix search, word -> term ids for mentions of several words,
+    trigram -> words for near-miss spellings of a word, and the synonym groups of SYMPTOM_SYNONYMS restricted to known terms.
+    '''
+    def __init__(self, indexes: dict):
+        self.mtimes = {year: index.mtimes.get('symp') for year, index in indexes.items()}
+        self.postings = collections.defaultdict(dict)
+        for year, index in indexes.items():
+            for term, IDs in index.postings.get(('symp', ANY_SYMPTOM), {}).items():
+                self.postings[term][year] = IDs
+        self.terms = sorted(self.postings, key=str.lower)
+        self._lower = [term.lower() for term in self.terms]
+        self._exact = dict(zip(self._lower, self.terms))
+        reports = [sum(len(IDs) for IDs in self.postings[term].values()) for term in self.terms]
+        self._word_terms = collections.defaultdict(set)    # word -> term ids
+        self._word_reports = collections.Counter()
+        for i, term in enumerate(self._lower):
+            for word in set(re.findall('[a-z0-9]+', term)):
+                self._word_terms[word].add(i)
+                self._word_reports[word] += reports[i]
+        self._grams = collections.defaultdict(set)    # trigram -> words
+        for word in self._word_terms:
+            for gram in _trigrams(word):
+                self._grams[gram].add(word)
+        self.synonyms = {word: [self._exact[t.lower()] for t in terms if t.lower() in self._exact]
+                         for word, terms in SYMPTOM_SYNONYMS.items()}
+        self._resolved = collections.OrderedDict()    # mention -> terms, LRU bounded by SYMPTOM_MEMO_SIZE
+        self._lock = threading.Lock()                 # guards self._resolved
+
+    def is_current(self, ds) -> bool:
+        return all(ds.source_mtime(f'{year}symp') == mtime for year, mtime in self.mtimes.items())
+
+    def resolve(self, mention: str) -> list:
+        '''
+        Input: symptom as mentioned, e.g. 'sick', 'headach', 'injection site'
+        Output: matching terms: synonym group, exact term or terms starting with the mention (also in singular),
+                else the same after correcting near-miss spellings word by word, else terms with all the words;
+                [] if nothing matches (the mention is then used as given)
+        '''
+        key = ' '.join(str(mention).lower().replace('_', ' ').split())
+        with self._lock:
+            terms = self._resolved.get(key)
+            if terms is not None:
+                self._resolved.move_to_end(key)
+                return terms
+        terms = self._resolve(key)
+        with self._lock:
+            self._resolved[key] = terms
+            while len(self._resolved) > SYMPTOM_MEMO_SIZE:
+                self._resolved.popitem(last=False)
+        return terms
+
+    def _resolve(self, key: str) -> list:
+        words = key.split()
+        singular = ' '.join(_singular(word) for word in words)
+        terms = self._lookup(key) or self._lookup(singular)
+        if terms:
+            return terms
+        # word by word: known words (or near-miss spellings of one), then terms with all of them
+        corrected = [self._correct(word) for word in words]
+        if None in corrected:
+            return []
+        corrected = ' '.join(corrected)
+        if corrected not in (key, singular):
+            terms = self._lookup(corrected)
+            if terms:
+                return terms
+        if len(words) > 1:
+            ids = set.intersection(*(self._word_terms[word] for word in corrected.split()))
+            return [self.terms[i] for i in sorted(ids)]
+        return []
+
+    def _lookup(self, key: str) -> list:
+        # synonym group, exact term, or terms starting with the mention
+        if self.synonyms.get(key):
+            return self.synonyms[key]
+        if key in self._exact:
+            return [self._exact[key]]
+        if len(key) >= SYMPTOM_PREFIX_MIN:
+            start = bisect.bisect_left(self._lower, key)
+            end = bisect.bisect_left(self._lower, key + '\uffff')
+            if end > start:
+                return self.terms[start:end]
+        return []
+
+    def _correct(self, word: str):
+        # the word as in the vocabulary (or its singular), its closest spelling within 1-2 edits, None if unknown
+        for form in (word, _singular(word)):
+            if form in self._word_terms:
+                return form
+        if len(word) < SYMPTOM_FUZZY_LENGTH:
+            return None
+        limit = 1 if len(word) < 8 else 2
+        candidates = collections.Counter(other for gram in _trigrams(word) for other in self._grams.get(gram, ()))
+        best = None
+        for other, shared in candidates.most_common(50):
+            distance = _edit_distance(word, other, limit)
+            if distance <= limit and (best is None or (distance, -self._word_reports[other]) < best[0]):
+                best = ((distance, -self._word_reports[other]), other)    # ties go to the more reported word
+        return best[1] if best else None
+
+    def expand(self, mentions: list) -> list:
+        '''
+        Input: symptom traits of a filter
+        Output: the terms they resolve to (unresolved mentions kept as given)
+        '''
+        expanded = []
+        for mention in mentions:
+            terms = self.resolve(mention) or [mention]
+            if terms != [mention]:
+                print(f'Symptom {mention!r} resolved to {terms[:10]}{" ..." if len(terms) > 10 else ""}')
+            expanded.extend(t for t in terms if t not in expanded)
+        return expanded
+
+
+symptom_indexes = {}    # years -> SymptomIndex, only the current one is kept
+_symptom_lock = threading.Lock()
+
+def symptom_index(ds=dataset_V) -> SymptomIndex:
+    '''
+    Output: symptom index over all years, built on first use and rebuilt if a symptom csv changed
+    '''
+    with _symptom_lock:
+        index = symptom_indexes.get(tuple(ds.years))
+        if index is None or not index.is_current(ds):
+            indexes = {year: year_index(year, ds) for year in ds.years}
+            index = SymptomIndex({y: i for y, i in indexes.items() if 'symp' in i.mtimes})
+            symptom_indexes.clear()    # an index of other years (before an ingest) is not used again
+            symptom_indexes[tuple(ds.years)] = index
+    return index
+
+
+
+
+
+########################## Tracing ###########################
+METRICS_PORT = int(os.environ.get('VAERS_METRICS_PORT', 9464))    # local metrics endpoint, 0 to disable
+trace_log = logging.getLogger('vaers.trace')    # one JSON line per request
+trace_log.addHandler(logging.StreamHandler())
+trace_log.setLevel(os.environ.get('VAERS_TRACE_LOG', 'INFO'))
+trace_log.propagate = False
+
+
+class Metrics:
+    '''
+    In-process counters and latency histograms, rendered in Prometheus text format.
+    '''
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._counters = collections.defaultdict(float)    # (name, labels) -> value
+        self._histograms = {}                              # (name, labels) -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        with self._lock:
+            histogram = self._histograms.setdefault((name, tuple(sorted(labels.items()))), [[0] * len(self.BUCKETS), 0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def snapshot(self) -> dict:
+        '''
+        Output: {'counters': {name{labels}: value}, 'histograms': {name{labels}: {'count', 'sum', 'buckets'}}}
+        '''
+        with self._lock:
+            return {'counters': {name + _labels(labels): v for (name, labels), v in self._counters.items()},
+                    'histograms': {name + _labels(labels): {'count': h[2], 'sum': h[1], 'buckets': dict(zip(self.BUCKETS, h[0]))}
+                                   for (name, labels), h in self._histograms.items()}}
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f'{name}{_labels(labels)} {value}')
+            for (name, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                for bound, n in zip(self.BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {n}')
+                lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{_labels(labels)} {total}')
+                lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels) -> str:
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+
+metrics = Metrics()
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    '''
+    Record of one chat turn: wall time per stage, tokens, rows per dataset_V frame and payload size.
+    Helpers (stage, record, ...) write to the trace active in the current context.
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.stages = []                                 # (stage, seconds)
+        self.counters = collections.defaultdict(int)     # e.g. 'extract_prompt_tokens', 'payload_chars'
+        self.rows = collections.defaultdict(lambda: {'scanned': 0, 'returned': 0})    # frame name -> rows
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = current_trace.set(self)
+        try:
+            yield self
+        finally:
+            current_trace.reset(token)
+
+    def mark(self, name: str):
+        # time since the start of the turn, e.g. first/last token
+        seconds = time.perf_counter() - self.start
+        with self._lock:
+            self.stages.append((name, seconds))
+        metrics.observe('vaers_stage_seconds', seconds, stage=name)
+
+    def finish(self):
+        seconds = time.perf_counter() - self.start
+        metrics.observe('vaers_request_seconds', seconds, handler=self.name)
+        trace_log.info(json.dumps({'trace': self.name, 'seconds': round(seconds, 4),
+                                   'stages': [[name, round(t, 4)] for name, t in self.stages],
+                                   'counters': dict(self.counters), 'rows': dict(self.rows)}))
+
+
+@contextlib.contextmanager
+def stage(name: str, detail: str = None):
+    '''
+    Time a stage of the pipeline, as 'detail' in the active trace and as 'name' in the histograms
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe('vaers_stage_seconds', seconds, stage=name)
+        trace = current_trace.get()
+        if trace is not None:
+            with trace._lock:
+                trace.stages.append((detail or name, seconds))
+
+
+def record(name: str, value: int = 1):
+    metrics.inc(f'vaers_{name}_total', value)
+    trace = current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.counters[name] += value
+
+
+def record_tokens(name: str, result):
+    # token counts of a Gemini response (for streamed responses, once fully iterated)
+    usage = getattr(result, 'usage_metadata', None)
+    if usage is not None:
+        record(f'{name}_prompt_tokens', getattr(usage, 'prompt_token_count', 0) or 0)
+        record(f'{name}_response_tokens', getattr(usage, 'candidates_token_count', 0) or 0)
+
+
+def record_rows(name: str, scanned: int, returned: int):
+    metrics.inc('vaers_rows_scanned_total', scanned, file=name[4:])
+    metrics.inc('vaers_rows_returned_total', returned, file=name[4:])
+    trace = current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.rows[name]['scanned'] += scanned
+            trace.rows[name]['returned'] += returned
+
+
+def in_context(fn, *args):
+    # run fn(*args) in a copy of the current context (with the active trace), for thread pools
+    return functools.partial(contextvars.copy_context().run, fn, *args)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = metrics.render(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps({**metrics.snapshot(), 'caches': cache_stats(), 'sessions': len(sessions),
+                                             'dataset_bytes': dataset_V.memory_usage()}), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_POST(self):
+        if self.path != '/ingest':
+            self.send_error(404)
+            return
+        body = json.dumps(ingest(dataset_V)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    '''
+    Serve /metrics (Prometheus text) and /metrics.json on localhost, and POST /ingest to pick up new data
+    '''
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Metrics on http://127.0.0.1:{port}/metrics')
+    return server
+
+
+
 
 
 ########################## Initiate LLM ###########################
 genai.configure(api_key=os.environ["API_KEY"])
 
-model = genai.GenerativeModel(
-    "gemini-1.5-flash",
-    system_instruction="You are a (human) vaccine data expert. You have a helper called 'data assistant' that will retrieve useful data for you in csv format.\
-        Such useful data comes from the VAERS datasets on human vaccine adverse event reports from 2014 to 2013 (inlc) from the US.\
+def chat_instruction(ds=dataset_V) -> str:
+    first, last = year_span(ds)
+    return f"You are a (human) vaccine data expert. You have a helper called 'data assistant' that will retrieve useful data for you in csv format.\
+        Such useful data comes from the VAERS datasets on human vaccine adverse event reports from {first} to {last} (incl.) from the US.\
         The datasets include detailed information including specific vaccine type, e.g. plague vaccine, covid vaccine, etc.\
         You may use the datasets as examples if no specific data is required.\
         You may use the datasets as examples even when the question is not limited to the US.\
         Base your response on VAERS data as much as possible, but always mention that selected data from VAERS is used.\
         Be caring and profesional. Give concise answers. Focus your main discussion on vaccines data and the information you can infer from them.\
-        Provide additional information with caution. Do NOT give medical advises, instead refer the user to a doctor.",
-    )
+        Provide additional information with caution. Do NOT give medical advises, instead refer the user to a doctor."
 
-chat = model.start_chat(history=[])
+
+model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=chat_instruction())
+
+
+# planning bots: the static instructions are rendered once and used as system instruction,
+# uploaded once with Gemini context caching where possible, so only the query is sent per call
+PROMPT_CACHING = os.environ.get('VAERS_PROMPT_CACHING', '1') == '1'
+PROMPT_CACHE_TTL = datetime.timedelta(hours=1)
+_static_models = {}    # name -> (expiry time, model)
+_static_generation = 0    # incremented by forget_static_models, models built before are not kept
+_static_lock = threading.Lock()                              # guards _static_models and _static_locks
+_static_locks = collections.defaultdict(threading.Lock)      # one upload at a time per bot, bots uploaded in parallel
+
+def static_model(name: str, prompt) -> genai.GenerativeModel:
+    '''
+    Input: name of the bot, function rendering its static prompt
+    Output: model with the prompt as system instruction
+    '''
+    with _static_lock:
+        entry = _static_models.get(name)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        name_lock = _static_locks[name]
+    # the upload is a network call, other bots are served meanwhile
+    with name_lock:
+        with _static_lock:
+            entry = _static_models.get(name)
+            if entry is not None and entry[0] > time.time():    # uploaded while waiting
+                return entry[1]
+            generation = _static_generation
+        instruction = prompt()
+        bot, expiry = None, float('inf')
+        if PROMPT_CACHING:
+            try:
+                cached = genai.caching.CachedContent.create(model='models/gemini-1.5-flash-001', display_name=name,
+                                                            system_instruction=instruction, ttl=PROMPT_CACHE_TTL)
+                bot = genai.GenerativeModel.from_cached_content(cached_content=cached)
+                expiry = time.time() + PROMPT_CACHE_TTL.total_seconds() - 60
+            except Exception as e:    # e.g. prompt below the minimum size for context caching
+                print(f'Context caching not used for {name}:', e)
+        if bot is None:
+            bot = genai.GenerativeModel("gemini-1.5-flash", system_instruction=instruction)
+        with _static_lock:
+            if generation == _static_generation:
+                _static_models[name] = (expiry, bot)
+        return bot
+
+
+def forget_static_models() -> None:
+    # drop the planning bots, their prompts are rendered again on next use (e.g. after new years are ingested)
+    global _static_generation
+    with _static_lock:
+        _static_models.clear()
+        _static_generation += 1
+
+
+
+
+########################## Query caches ###########################
+CACHE_TTL = float(os.environ.get('VAERS_CACHE_TTL', 7 * 24 * 3600))    # seconds
+QUERY_CACHE_PATH = f'{CACHE_DIR}/query_cache.pkl'
+SEMANTIC_CACHE = os.environ.get('VAERS_SEMANTIC_CACHE', '0') == '1'      # match near-duplicate questions by embedding
+SEMANTIC_THRESHOLD = float(os.environ.get('VAERS_SEMANTIC_THRESHOLD', 0.93))
+MISSING = object()
+
+
+class QueryCache:
+    '''
+    LRU cache with a time-to-live and hit/miss counters, picklable for persistence.
+    '''
+    persist = True    # saved to QUERY_CACHE_PATH at exit
+    def __init__(self, max_items: int, ttl: float = CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._items = collections.OrderedDict()    # key -> (time stored, value)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != '_lock'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _lock=threading.Lock())
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.time() - item[0] > self.ttl:
+                self._items.pop(key, None)
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.time(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        return {'items': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+class SemanticCache(QueryCache):
+    '''
+    Question embeddings -> key of the extract cache, matched by cosine similarity above threshold.
+    '''
+    def __init__(self, max_items: int, threshold: float = SEMANTIC_THRESHOLD, ttl: float = CACHE_TTL):
+        super().__init__(max_items, ttl)
+        self.threshold = threshold
+
+    def embed(self, text: str):
+        try:
+            vector = np.asarray(genai.embed_content(model='models/text-embedding-004', content=text)['embedding'])
+        except Exception:
+            return None
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def match(self, vector: np.ndarray):
+        with self._lock:
+            keys = list(self._items)
+            vectors = [self._items[key][1] for key in keys]
+        if vectors:
+            similarity = np.stack(vectors) @ vector
+            best = int(np.argmax(similarity))
+            if similarity[best] >= self.threshold:
+                return self.get(keys[best])    # counts the hit, checks the ttl
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def add(self, vector: np.ndarray, key):
+        self.put(key, vector)
+
+    def get(self, key, default=None):
+        item = super().get(key, MISSING)
+        return default if item is MISSING else key
+
+
+def frame_bytes(value) -> int:
+    # memory of a retrieval: dataframes, dicts of dataframes, or other values by their text length
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sum(frame_bytes(v) for v in value.values())
+    return len(str(value))
+
+
+class FrameCache(QueryCache):
+    '''
+    QueryCache of retrieved data, bounded by max_bytes as well. Kept in memory only: the entries are up to
+    max_bytes of dataframes (RETRIEVE_CACHE_BYTES), too large to pickle into QUERY_CACHE_PATH at every exit
+    and load at every start, while the planning caches it would be saved with are a few MB at most.
+    '''
+    persist = False
+
+    def __init__(self, max_items: int, max_bytes: int, ttl: float = CACHE_TTL):
+        super().__init__(max_items, ttl)
+        self.max_bytes = max_bytes
+        self._bytes = {}    # key -> bytes
+
+    def put(self, key, value):
+        size = frame_bytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._items[key] = (time.time(), value)
+            self._items.move_to_end(key)
+            self._bytes = {k: self._bytes[k] for k in self._items if k in self._bytes}    # drop sizes of expired items
+            self._bytes[key] = size
+            while len(self._items) > self.max_items or sum(self._bytes.values()) > self.max_bytes:
+                self._bytes.pop(self._items.popitem(last=False)[0], None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes.clear()
+
+    def stats(self) -> dict:
+        return {**super().stats(), 'bytes': sum(self._bytes.values())}
+
+
+def _load_query_caches() -> dict:
+    try:
+        with open(QUERY_CACHE_PATH, 'rb') as f:
+            caches = pickle.load(f)
+        print(f'Query caches loaded from {QUERY_CACHE_PATH}.')
+        return caches
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return {}
+
+def save_query_caches() -> None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(QUERY_CACHE_PATH + '.tmp', 'wb') as f:
+        pickle.dump({name: cache for name, cache in query_caches.items() if cache.persist}, f)
+    os.replace(QUERY_CACHE_PATH + '.tmp', QUERY_CACHE_PATH)
+
+def cache_stats() -> dict:
+    return {name: cache.stats() for name, cache in query_caches.items()}
+
+
+# level 1: normalised input text -> extracted query (+ embeddings for near-duplicates)
+# level 2: extracted query -> action list, and action list (+ csv mtimes) -> retrieved data
+RETRIEVE_CACHE_BYTES = int(os.environ.get('VAERS_RETRIEVE_CACHE_BYTES', 256 * 1024**2))    # memory budget of cached retrievals
+query_caches = {'extract': QueryCache(4096), 'semantic': SemanticCache(4096), 'action': QueryCache(1024),
+                'retrieve': FrameCache(128, RETRIEVE_CACHE_BYTES)}
+query_caches.update({name: cache for name, cache in _load_query_caches().items() if name in query_caches and query_caches[name].persist})
+atexit.register(save_query_caches)
+
+
+def cached_extract(name: str, input_text: str, extract) -> dict:
+    '''
+    Input: name of the extract bot, user input, the extract bot
+    Output: extract(input_text), from the cache if the same (or, optionally, a similar) question was asked before
+    '''
+    key = (name, ' '.join(input_text.lower().split()).rstrip('?!. '))
+    extracted = query_caches['extract'].get(key, MISSING)
+    if extracted is not MISSING:
+        return extracted
+    vector = query_caches['semantic'].embed(key[1]) if SEMANTIC_CACHE else None
+    if vector is not None:
+        similar = query_caches['semantic'].match(vector)
+        extracted = query_caches['extract'].get(similar, MISSING) if similar and similar[0] == name else MISSING
+        if extracted is not MISSING:
+            query_caches['extract'].put(key, extracted)
+            return extracted
+    extracted = extract(input_text)
+    query_caches['extract'].put(key, extracted)
+    if vector is not None:
+        query_caches['semantic'].add(vector, key)
+    return extracted
+
+
+def cache_key(value) -> str:
+    return json.dumps(value, sort_keys=True, default=str)
 
 
 
@@ -52,16 +1166,65 @@ chat = model.start_chat(history=[])
 ########################## Define different task performers ###########################
 
 # image analysis bot
+IMAGE_MAX_SIDE = int(os.environ.get('VAERS_IMAGE_MAX_SIDE', 1024))    # pixels, longest side of uploaded images
+IMAGE_QUALITY = 85    # JPEG quality of uploaded images
+
+def encode_image(path: str) -> dict:
+    '''
+    Input: path of an image file
+    Output: the image downscaled to IMAGE_MAX_SIDE and JPEG-encoded, as a blob for the model (encoded once per turn)
+    '''
+    with stage('image_encode'):
+        image = PIL.Image.open(path)
+        image.draft('RGB', (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))    # JPEG: decode at a reduced scale
+        image = PIL.ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=IMAGE_QUALITY)
+    record('image_bytes', buffer.tell())
+    return {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}
+
+
 def image_assistant(input_image):
     instruction_prompt = 'If the image is of the skin of a human body part, produce a JSON summary with the following fields: \
         position, estimated_size, shape, color, texture, abnomality. Put "unsure" as the value if unsure for one field.'
     example_prompt = 'Example output: {"position": "neck","estimated_size": "10cm", "shape": "circular","color": "brown", "texture": "smooth", "abnomality": false}.\
         Example output:{"position": "unsure","estimated_size": "1cm-5cm", "shape": "irregular","color": "brown", "texture": "unsure", "abnomality": unsure}.'
-    result = model.generate_content([input_image, '\n\n', instruction_prompt+example_prompt])
+    with stage('image'):
+        result = model.generate_content([input_image, '\n\n', instruction_prompt+example_prompt])
+    record_tokens('image', result)
     return result.text
 
 # input extract bot
 def input_extract(input_text: str) -> dict:
+    with stage('extract'):
+        return cached_extract('input_extract', input_text, _input_extract)
+
+INPUT_EXTRACT_EXAMPLES = [
+    ('Hi.', 'None'),
+    ('Thank you!', 'None'),
+    ('What are the most common symptoms caused by corona vaccines?', '{"symptoms": "all", "vaccine": "COVID"}'),
+    ('Should I get TBE vaccine?', '{"vaccine": "TBE"}'),
+    ('What are the most popular vaccines in the US?', 'None'),
+    ('Give me all the reports in recent years', '{"years": [2021, 2022, 2023]}'),
+    ('Give me all the reports on TBE vaccines in recent years', '{"vaccine": "TBE", "years": [2021, 2022, 2023]}'),
+    ('Are old people more suseptible to vaccine side effect?', '{"age": "old"}'),
+    ('Should my dog get vaccinated?', 'None'),
+    ('Do women or men get more side effects from COVID vaccines?', '{"vaccine": "COVID", "sex": "all"}'),
+    ('How many people reported in year 2018 and 2019?', '{"ID": "all", "year": [2018, 2019]}'),
+    ('What is the trend of adverse event reports for polio vaccine?', '{"vaccine": "polio"}'),
+    ('What are the most common side effects from flu vaccine among children?', '{"vaccine": "flu", "age": "children", "symptoms": "all"}'),
+    ('Are children or seniors more susceptible to COVID vaccine side effects?', '{"vaccine": "COVID", "age": "children or old", "symptoms": "all"}'),
+    ('How deadly is COVID vaccine for young adults?', '{"vaccine": "COVID", "symptoms": "death", "age": "young adults"}'),
+    ('Is the above respondse based on the VAERS database?', 'None'),
+    ('Hello.', 'None'),
+]
+
+def input_extract_prompt(ds = dataset_V) -> str:
+    first, last = year_span(ds)
+    recent = [last - 2, last - 1, last]
     # find the relevant information in the input
     instruction_condense = 'Instruction: Find medical and patient related key-value pairs in the input. Respond "None" if no such info found.\
         Possible keys are "year", "date", "ID", "vaccine", "disease", "symptoms", "age", "sex", "died" or similar fields,\
@@ -72,36 +1235,26 @@ def input_extract(input_text: str) -> dict:
             {"vaccine": "(vaccine name)", "symptoms": "(symptom name)", "age": (int) or string discription (young, old, under 30, etc.)}.\
         If the input has a field requiring general information, e.g. all symptoms concerning COVID vaccine, return in the format\
             {"symptoms": "all", "vaccine": "COVID"}.\
-        The "year" key can only have value of an integer between 2014 to 2023 (incl.) or a list of such integers; "recent years" count as the last three years;\
+        The "year" key can only have value of an integer between ' + f'{first} to {last} (incl.) or a list of such integers; "recent years" count as {recent};\
             do not include "year" key if unsure of year(s).\
         The "age" key, if present, can be a ganeral age group, eg old, children, middle-age, etc.\
         The word "side effects" or similar should be associated with "symptoms".\
         If both women and men are mentioned, set value "all" for "sex" key.\
         The values can contain "and" or "or" if several values are concerned.\n\n'
     # example prompt
-    instruction_condense += 'Example input-output: "Hi.", "None".\n'
-    instruction_condense += 'Example input-output: "Thank you!", "None".\n'
-    instruction_condense += 'Example input-output: "What are the most common symptoms caused by corona vaccines?", "{"symptoms": "all", "vaccine": "COVID"}".\n'
-    instruction_condense += 'Example input-output: "Should I get TBE vaccine?", "{"vaccine": "TBE"}".\n'
-    instruction_condense += 'Example input-output: "What are the most popular vaccines in the US?", "None".\n'
-    instruction_condense += 'Example input-output: "Give me all the reports in recent years", "{"years": [2021, 2022, 2023]}".\n'
-    instruction_condense += 'Example input-output: "Give me all the reports on TBE vaccines in recent years", "{"vaccine": "TBE", "years": [2021, 2022, 2023]}".\n'
-    instruction_condense += 'Example input-output: "Are old people more suseptible to vaccine side effect?", "{"age": "old"}".\n'
-    instruction_condense += 'Example input-output: "Should my dog get vaccinated?", "None".\n'
-    instruction_condense += 'Example input-output: "Do women or men get more side effects from COVID vaccines?", "{"vaccine": "COVID", "sex": "all"}".\n'
-    instruction_condense += 'Example input-output: "How many people reported in year 2018 and 2019?", "{"ID": "all", "year": [2018, 2019]}".\n'
-    instruction_condense += 'Example input-output: "What is the trend of adverse event reports for polio vaccine?", "{"vaccine": "polio"}".\n'
-    instruction_condense += 'Example input-output: "What are the most common side effects from flu vaccine among children?", "{"vaccine": "flu", "age": "children", "symptoms": "all"}".\n'
-    instruction_condense += 'Example input-output: "Are children or seniors more susceptible to COVID vaccine side effects?", "{"vaccine": "COVID", "age": "children or old", "symptoms": "all"}".\n'
-    instruction_condense += 'Example input-output: "How deadly is COVID vaccine for young adults?", "{"vaccine": "COVID", "symptoms": "death", "age": "young adults"}".\n'
-    instruction_condense += 'Example input-output: "Is the above respondse based on the VAERS database?", "None".\n'
-    instruction_condense += 'Example input-output: "Hello.", "None".\n'
+    instruction_condense += ''.join(f'Example input-output: "{q}", "{a}".\n'.replace('[2021, 2022, 2023]', str(recent)) for q, a in INPUT_EXTRACT_EXAMPLES)
     # force format of output
     instruction_condense += '**IMPORTANT**: ONLY RESPOND "None" OR DICTIONARY WITH ABOVE  FORMAT. \
         DICTIONARY MUST BE INFERRED FROM INPUT. DO NOT EXPLAIN. DO NOT INCLUDE LINE BREAKS.'
+    return instruction_condense
+
+
+def _input_extract(input_text: str) -> dict:
     # generated condensed input
-    extracted_request = model.generate_content([input_text, '\n\n', instruction_condense], safety_settings={
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH}).text
+    extracted_request = static_model('input_extract', input_extract_prompt).generate_content([input_text], safety_settings={
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH})
+    record_tokens('extract', extracted_request)
+    extracted_request = extracted_request.text
     # # test
     # print(extracted_request.replace("'", '"'))
     # print(json.loads(extracted_request.replace("'", '"')))
@@ -117,39 +1270,34 @@ def input_extract(input_text: str) -> dict:
 
 
 # data retrieval bot
-def data_assistant(extracted_input, vc = vaccine_code, ds = dataset_V) -> list:
-    '''
-    Input: extracted input
-    Output: a list of actions taken on files, plus a sub-dict of vaccine codes
-    '''
-    input_dict = input_extract(extracted_input)
+def data_assistant_prompt(ds = dataset_V) -> str:
+    first, last = year_span(ds)
     # instrcution prompt
     instructions = f"INSTRUCTION: You are assisting a programmer on data retrieval. \
         Follow the following instruction to give information for accessing the relevant parts of the VAERS datasets,\
         based on the information given in the input.\n\n"
-    instructions += "DATASET: The intended Python code will perform on datasets in the format of a Python dictionary, called 'dataset'. \
-        The dataset consists of passive adverse event reports related to vaccines in the US between year 2014 to year 2023.\
+    instructions += f"DATASET: The intended Python code will perform on datasets in the format of a Python dictionary, called 'dataset'. \
+        The dataset consists of passive adverse event reports related to vaccines in the US between year {first} to year {last}.\
         The dataset dictionary has keys of the following format: \
-        '{year}data', '{year}symp', '{year}vax', where you can replacing {year} with year numbers between 2014 to 2023 (incl.), \
+        '{{year}}data', '{{year}}symp', '{{year}}vax', where you can replacing {{year}} with year numbers between {first} to {last} (incl.), \
         and the values are panda dataframes.\
         All files from the same year contain the same patients, identified by their VAERS_ID.\
-        The '{year}data' files contain ganeral information of the patients,\
-        the '{year}symp' files contain discriptions of their symptoms,\
-        the '{year}vax' files contain discriptions of the vaccines they recieved.\n"
+        The '{{year}}data' files contain ganeral information of the patients,\
+        the '{{year}}symp' files contain discriptions of their symptoms,\
+        the '{{year}}vax' files contain discriptions of the vaccines they recieved.\n"
     instructions += f'''STEPS: Follow these steps for the task:\n\
-        1. Example dataframe: Take a look at the first few lines of the files from 2014 and use this as reference for the data structure,\n\
-            '2014data':\n{ds['2014data'].head()}\n\
-            '2014symp':\n{ds['2014symp'].head()}\n\
-            '2014vax':\n{ds['2014vax'].head()}\n\n\
+        1. Example dataframe: Take a look at the first few lines of the files from {first} and use this as reference for the data structure,\n\
+            '{first}data':\n{ds.head(f'{first}data')}\n\
+            '{first}symp':\n{ds.head(f'{first}symp')}\n\
+            '{first}vax':\n{ds.head(f'{first}vax')}\n\n\
         2. Use the input dictionary to determine the objective: 'filenamn', 'filter'('column', 'trait'), 'info'.\
             For 'filename', if there is a 'year' key, consider only and all file names containing those years;\
             each key with 'all' as value should be mapped to a column name in a file and be considered as 'info';\
             all other keys are consider 'filter', where each one is mapped to a column name and its value considered as 'trait';
             if applicable, consider a few synonyms for 'trait' for the next step.\
-            If a vaccine or disease is mentioned, refer to the dict below of all vaccines in the dataset, which includes their codes and names,\n\
-                VAX_CODE: \n{vc}.\n\
-            If the requied vaccine or decease has only a vague description, e.g. corona or flu, you should take all relevant vaccines in to consideration.\
-            If year is not specified, consider all years (2014-2013 incl.).\
+            If a vaccine or disease is mentioned, filter the 'VAX_TYPE' column of the '{{year}}vax' files by the vaccine or disease as mentioned,\
+                e.g. ["flu"] or ["corona"]; it is mapped to the vaccine codes later.\
+            If year is not specified, consider all years ({first}-{last} incl.).\
             If 'age' key has a general description string value, consider:\n\
                     'infant' to be age 0 to 3,\
                     'children' to be age 0 to 14,\
@@ -165,7 +1313,7 @@ def data_assistant(extracted_input, vc = vaccine_code, ds = dataset_V) -> list:
                 {"filename": filename, "filter": {"trait_column_1": ["trait",..., "trait"]}, "info": ["info_column",..., "info_column"]}, \
                 sub_VAX_CODE].\n\
             All trait_column and info_column should be actual columns in a file with filename. All traits should be possible values under the column, inferred from input.\
-                "VAX_TYPE" traits should be vaccine codes given as keys in VAX_CODE.\
+                "VAX_TYPE" traits should be vaccine or disease names as mentioned in the input.\
                 "AGE" traits should be a list of numbers and only numbers.\
                 Time/date related information is in the "RECVDATE" column in "{year}data" files.\
                 If need trait_column and info_column from different files, draw these files separately.\n\
@@ -177,8 +1325,7 @@ def data_assistant(extracted_input, vc = vaccine_code, ds = dataset_V) -> list:
                 filtered_df = ds[filename].loc[df["VAERS_ID"].isin(ID_filtered)]; and\n\
             iv) return filtered dataframe, or further extract only relevant columns:\n\
                 sub_df["info_column", ..., "info_column"].\n\
-            v) after all above is done for all files involved, the a sub-dict of VAX_CODE, denoted by sub_VAX_CODE, is used for further reference,\
-                which contains all vaccines relevant to what is mentioned in the input (as vaccine or disease). Return empty dict if no specific vaccine or disease is concerned.\
+            v) after all above is done for all files involved, the vaccine codes of the "VAX_TYPE" traits are filled in sub_VAX_CODE; always return it as an empty dict.\
             Explanation of the output:\
                 The list contains information of all files needed. For each file, filename, relevant trait filters and relevant columns are given.\
                     You may call each file at most once.\
@@ -186,55 +1333,66 @@ def data_assistant(extracted_input, vc = vaccine_code, ds = dataset_V) -> list:
                     There can be duplicated "trait_column" if different traits are needed; retrun empty dict for "filter" if no "trait_column"-"trait" pair is present.\
                     If multiple string traits are given, they should be less than 5 and they should be synomyms, e.g. "sick" and "nausea".\
                     Return empty list as value of "info" if no specific column is needed.\
-                The dictionary contains relevant vaccine codes and names for later reference; return empty disctionary if non specific vaccine is relevant.\
+                The dictionary is left empty, it is filled in later.\
                 The string is a concise discription of what the code will do, once inserted the values from the above list.\n\n'
     instructions += "ADDITIONAL INFO: All COVID related requests only concern year 2020 and onwards"
     # example prompt
     instructions += 'Example input: "{"symptoms": "all", "vaccine": "COVID"}";\
-        output: [{"filename": "2020vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+        output: [{"filename": "2020vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2020symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                {"filename": "2021vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+                {"filename": "2021vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2021symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                {"filename": "2022vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+                {"filename": "2022vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2022symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                {"filename": "2023vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+                {"filename": "2023vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2023symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                {"COVID19": "Coronavirus 2019 vaccine", "COVID19-2": "Coronavirus 2019 vaccine, bivalent"}].\n\n'
+                {}].\n\n'
     instructions += 'Example input: "{"age": "old", "year": "2021, 2022, 2023"}";\
         output: [{"filename": "2021data", "filter": {"AGE_YRS", [60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100]}, "info": []},\
                 {"filename": "2022data", "filter": {"AGE_YRS", [60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100]}, "info": []},\
                 {"filename": "2023data", "filter": {"AGE_YRS", [60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100]}, "info": []},\
                 {}].\n\n'
     instructions += 'Example input: "{"vaccine": "COVID", "sex": "all"}";\
-        output: [{"filename": "2020vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+        output: [{"filename": "2020vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2020data", "filter": {}, "info": ["SEX"]},\
-                {"filename": "2021vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+                {"filename": "2021vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2021data", "filter": {}, "info": ["SEX"]},\
-                {"filename": "2022vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+                {"filename": "2022vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2022data", "filter": {}, "info": ["SEX"]},\
-                {"filename": "2023vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+                {"filename": "2023vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2023data", "filter": {}, "info": ["SEX"]},\
-                {"COVID19": "Coronavirus 2019 vaccine", "COVID19-2": "Coronavirus 2019 vaccine, bivalent"}].\n\n'
+                {}].\n\n'
     instructions += 'Example input: "{"vaccine": "lyme", "age": "children", "symptoms": "all", "year": "2019 to 2021"}";\
-        output: [{"filename": "2019vax", "filter": {"LYME": ["COVID19", "COVID19_2"]}, "info": []},\
+        output: [{"filename": "2019vax", "filter": {"VAX_TYPE": ["lyme"]}, "info": []},\
                 {"filename": "2019data", "filter": {"AGE_YRS":[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]}, "info": []},\
                 {"filename": "2019symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                [{"filename": "2020vax", "filter": {"LYME": ["COVID19", "COVID19_2"]}, "info": []},\
+                [{"filename": "2020vax", "filter": {"VAX_TYPE": ["lyme"]}, "info": []},\
                 {"filename": "2020data", "filter": {"AGE_YRS":[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]}, "info": []},\
                 {"filename": "2020symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                [{"filename": "2021vax", "filter": {"LYME": ["COVID19", "COVID19_2"]}, "info": []},\
+                [{"filename": "2021vax", "filter": {"VAX_TYPE": ["lyme"]}, "info": []},\
                 {"filename": "2021data", "filter": {"AGE_YRS":[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]}, "info": []},\
                 {"filename": "2021symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                {"LYME": "Lyme disease vaccine"}].\n\n'
+                {}].\n\n'
     instructions += 'Example input: "{"vaccine": "COVID", "age": "children or old", "symptoms": "all", "year":2015}";\
-        output: [{"filename": "2015vax", "filter": {"VAX_TYPE": ["COVID19", "COVID19_2"]}, "info": []},\
+        output: [{"filename": "2015vax", "filter": {"VAX_TYPE": ["COVID"]}, "info": []},\
                 {"filename": "2015data", "filter": {"AGE_YRS":[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70, 71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100]}, "info": []},\
                 {"filename": "2015symp", "filter": {}, "info": ["SYMPTOM1", "SYMPTOMVERSION1", "SYMPTOM2", "SYMPTOMVERSION2", "SYMPTOM3", "SYMPTOMVERSION3", "SYMPTOM4", "SYMPTOMVERSION4", "SYMPTOM5", "SYMPTOMVERSION5"]},\
-                {"COVID19": "Coronavirus 2019 vaccine", "COVID19-2": "Coronavirus 2019 vaccine, bivalent"}].\n\n'
+                {}].\n\n'
     instructions += "**IMPORTANT**: ONLY RESPOND WITH A LIST OF THE ABOVE FORMAT OR 'None'. DO NOT EXPLAIN. DO NOT INCLUDE LINE BREAKS."
-    result = model.generate_content(['Please perform the task for: '+ str(input_dict),'\n\n', instructions],\
+    return instructions
+
+
+def data_assistant(extracted_input) -> list:
+    '''
+    Input: extracted input
+    Output: a list of actions taken on files, plus a sub-dict of vaccine codes
+    '''
+    input_dict = input_extract(extracted_input)
+    result = static_model('data_assistant', data_assistant_prompt).generate_content(['Please perform the task for: '+ str(input_dict)],\
                                     safety_settings={
-                                    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH}).text
+                                    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH})
+    record_tokens('planning', result)
+    result = result.text
     ## test
     # print('TEST data_assistant, all text output: ', result)
     # print('test, try JSON: ', result.split('\n')[1])
@@ -244,75 +1402,537 @@ def data_assistant(extracted_input, vc = vaccine_code, ds = dataset_V) -> list:
     try:
         result = json.loads(result.replace("'", '"'))
         print('Data assistant request sent.')
-        return result
+        return vaccine_resolver.resolve_actions(result)
     except:
         try:
             result = json.loads(result.split('\n')[1])
             print('Data assistant request sent.')
-            return result
+            return vaccine_resolver.resolve_actions(result)
         except:
             print('Data not requested.')
             # print('Data assistant request failed: invalid format for data_assistant output \n', result[:3] + ', ...')
             return None
 
+# query planning bot: one structured call, translated locally into the actions of data_assistant
+PLANNING_MODE = os.environ.get('VAERS_PLANNING', 'single')    # 'single' (query_extract) or 'legacy' (input_extract + data_assistant)
+
+class StructuredQuery(typing.TypedDict):
+    relevant: bool
+    years: list[int]
+    vaccines: list[str]
+    age_groups: list[str]
+    age_min: int
+    age_max: int
+    sex: list[str]
+    symptoms: list[str]
+    info: list[str]
+
+def query_prompt(ds = dataset_V) -> str:
+    first, last = year_span(ds)
+    return f'Instruction: Describe the data needed from the VAERS vaccine adverse event reports (US, {first} to {last} incl.) to answer the input.\
+    Set "relevant" to false if the input does not concern the reports, vaccine side effects or vaccine receivers (e.g. greetings, thanks, animals); other fields can then be left out.\
+    "years": integers between {first} and {last} (incl.), "recent years" are {[last - 2, last - 1, last]}; leave out if not specified.\
+    "vaccines": vaccine or disease names as mentioned, e.g. "COVID", "flu", "TBE".\
+    "age_groups": any of "infant", "children", "teenager", "young adult", "middle-age", "old"; or give "age_min"/"age_max" for explicit ages.\
+    "sex": "F" and/or "M"; leave out if both or not specified.\
+    "symptoms": specific symptoms, as MedDRA preferred terms where known, e.g. "Nausea", "Headache", "Death", else as mentioned; leave out for "all symptoms" or "side effects" in general.\
+    "info": what to break the reports down by, any of "symptoms", "age", "sex", "died", "hospital", "vaccine", "date", "state", "ID".\
+        "side effects" means "symptoms"; "how many" means "ID"; "deadly" means "died".'
+
+AGE_GROUPS = {'infant': (0, 3), 'baby': (0, 3), 'children': (0, 14), 'child': (0, 14), 'kids': (0, 14),
+              'teenager': (12, 19), 'young adult': (18, 35), 'adult': (18, 100), 'middle-age': (35, 60),
+              'old': (60, 100), 'senior': (60, 100), 'elderly': (60, 100)}
+INFO_COLUMNS = {'symptoms': ('symp', SYMPTOM_COLUMNS), 'age': ('data', ['AGE_YRS']), 'sex': ('data', ['SEX']),
+                'died': ('data', ['DIED']), 'hospital': ('data', ['HOSPITAL']), 'date': ('data', ['RECVDATE']),
+                'state': ('data', ['STATE']), 'vaccine': ('vax', ['VAX_TYPE']), 'ID': ('data', ['VAERS_ID'])}
+DEFAULT_INFO = ['symptoms', 'age', 'sex']
+VACCINE_ALIASES = {'covid': 'coronavirus', 'corona': 'coronavirus', 'sars-cov-2': 'coronavirus', 'flu': 'influenza',
+                   'tbe': 'tick-borne encephalitis', 'hpv': 'papillomavirus', 'chickenpox': 'varicella', 'shingles': 'zoster',
+                   'whooping cough': 'pertussis', 'hib': 'haemophilus', 'tuberculosis': 'bacillus calmette',
+                   'pneumonia': 'pneumococcal', 'meningitis': 'meningococcal', 'mpox': 'monkeypox',
+                   'hep': 'hepatitis', 'hepb': 'hepatitis b', 'hep b': 'hepatitis b', 'hep a': 'hepatitis a', 'swine flu': 'h1n1',
+                   # brands, the VAX_NAME and VAX_MANU of the reports add more (see vaccine_names)
+                   'comirnaty': 'covid19', 'spikevax': 'covid19', 'novavax': 'covid19', 'shingrix': 'zoster', 'zostavax': 'zoster',
+                   'gardasil': 'papillomavirus', 'cervarix': 'papillomavirus', 'prevnar': 'pneumococcal', 'pneumovax': 'pneumococcal',
+                   'fluzone': 'influenza', 'flucelvax': 'influenza', 'flumist': 'influenza', 'fluad': 'influenza', 'flublok': 'influenza',
+                   'engerix': 'hepatitis b', 'recombivax': 'hepatitis b', 'heplisav': 'hepatitis b', 'havrix': 'hepatitis a',
+                   'vaqta': 'hepatitis a', 'twinrix': 'hepab', 'varivax': 'varicella', 'proquad': 'mmrv', 'rotateq': 'rotavirus',
+                   'rotarix': 'rotavirus', 'bexsero': 'menb', 'trumenba': 'menb', 'menactra': 'meningococcal conjugate',
+                   'menveo': 'meningococcal conjugate', 'boostrix': 'tdap', 'adacel': 'tdap', 'arexvy': 'rsv', 'abrysvo': 'rsv'}
+VACCINE_STOPWORDS = {'vaccine', 'vaccines', 'vaccination', 'vaccinations', 'immunisation', 'immunization', 'virus', 'shot', 'shots', 'jab',
+                     'the', 'and', 'of', 'live', 'oral', 'all', 'any', 'every', 'other', 'type', 'types', 'kind', 'kinds'}
+
+
+def query_extract(input_text: str) -> dict:
+    '''
+    Input: user input
+    Output: structured query (dict of StructuredQuery fields), None if no data is needed
+    '''
+    with stage('extract'):
+        return cached_extract('query_extract', input_text, _query_extract)
+
+def _query_extract(input_text: str) -> dict:
+    result = static_model('query_extract', query_prompt).generate_content([input_text],
+                                    generation_config=genai.GenerationConfig(response_mime_type='application/json',
+                                                                             response_schema=StructuredQuery, temperature=0),
+                                    safety_settings={HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH})
+    record_tokens('extract', result)
+    try:
+        query = json.loads(result.text)
+    except ValueError:
+        print('Query extract failed: invalid output format.')
+        return None
+    print('Extracted query:', query)
+    return query if query.get('relevant') else None
+
+
+VACCINE_NAME_STOPWORDS = {'unknown', 'no', 'brand', 'name', 'manufacturer', 'inc', 'co', 'ltd', 'llc', 'corp', 'corporation',
+                          'company', 'laboratories', 'labs', 'pharmaceuticals', 'vaccines', 'vaccine', 'and', 'the', 'of'}
+VACCINE_MEMO_SIZE = 4096     # resolved mentions kept (LRU)
+VACCINE_UNMATCHED = 'no matching vaccine code'    # sub_VAX_CODE value of a mention resolved to no code
+
+
+def vaccine_names(ds = dataset_V) -> pd.DataFrame:
+    '''
+    Output: distinct (VAX_TYPE, VAX_NAME, VAX_MANU) of the reports, for brand and manufacturer mentions
+    '''
+    frames = []
+    for year in ds.years:
+        try:
+            frames.append(ds.read(f'{year}vax', ['VAX_TYPE', 'VAX_NAME', 'VAX_MANU']).drop_duplicates())
+        except (KeyError, FileNotFoundError, ValueError):    # file or columns not available
+            continue
+    return pd.concat(frames).drop_duplicates() if frames else pd.DataFrame(columns=['VAX_TYPE', 'VAX_NAME', 'VAX_MANU'])
+
+
+def _code_key(code: str) -> str:
+    # 'COVID19_2', 'covid19-2' -> 'covid192'
+    return re.sub('[^a-z0-9]', '', str(code).lower())
+
+
+def _words(text: str) -> list:
+    # 'haemophilus influenza B' is Hib, not an influenza vaccine
+    return re.findall('[a-z0-9]+', text.lower().replace('haemophilus influenza', 'haemophilus'))
+
+
+class VaccineResolver:
+    '''
+    Vaccine or disease mentions -> VAX_TYPE codes, from the code table:
+    code index (normalised code -> codes, searched by prefix), alias index (VACCINE_ALIASES),
+    disease index (word of the descriptions -> codes, searched by word or word prefix),
+    and name index (word of VAX_NAME / VAX_MANU in the reports -> codes, built on first use from names()).
+    '''
+    def __init__(self, codes: dict, names=None):
+        self.codes = codes
+        self._keys = sorted((_code_key(code), code) for code in codes)
+        self._words = collections.defaultdict(set)
+        for code, name in codes.items():
+            for word in _words(name):
+                self._words[word].add(code)
+        self._word_list = sorted(self._words)
+        self._names = names           # function returning the distinct VAX_TYPE, VAX_NAME, VAX_MANU
+        self._name_words = None       # word -> codes
+        self._resolved = collections.OrderedDict()    # mention -> codes, LRU bounded by VACCINE_MEMO_SIZE
+        self._lock = threading.Lock()                 # guards self._resolved and self._name_words
+
+    def forget(self):
+        # drop the name index and resolved mentions, e.g. after new reports were ingested
+        with self._lock:
+            self._name_words = None
+            self._resolved.clear()
+
+    def _name_index(self) -> dict:
+        with self._lock:
+            if self._name_words is not None or self._names is None:
+                return self._name_words or {}
+        name_words = collections.defaultdict(set)
+        try:
+            names = self._names()
+        except Exception as e:
+            print('Vaccine names not loaded:', e)
+            names = pd.DataFrame(columns=['VAX_TYPE', 'VAX_NAME', 'VAX_MANU'])
+        for row in names.itertuples(index=False):
+            if str(row.VAX_TYPE) not in self.codes:
+                continue
+            for word in set(_words(f'{row.VAX_NAME} {row.VAX_MANU}')):
+                if len(word) >= 3 and not word.isdigit() and word not in VACCINE_NAME_STOPWORDS:
+                    name_words[word].add(str(row.VAX_TYPE))
+        with self._lock:
+            self._name_words = dict(name_words)
+        return self._name_words
+
+    def specific(self, mention: str) -> bool:
+        # False for mentions of vaccines in general ('vaccines', 'all', 'any vaccine'), which do not restrict VAX_TYPE
+        return any(word not in VACCINE_STOPWORDS for word in str(mention).lower().split())
+
+    def resolve(self, mention: str) -> list:
+        '''
+        Input: vaccine or disease as mentioned, e.g. 'flu', 'corona', 'TBE', 'hepatitis B', 'COVID19_2'
+        Output: sorted matching codes (codes starting with the mention, or all of its words in the description)
+        '''
+        mention = ' '.join(word for word in str(mention).lower().split() if word not in VACCINE_STOPWORDS)
+        with self._lock:
+            found = self._resolved.get(mention)
+            if found is not None:
+                self._resolved.move_to_end(mention)
+                return found
+        found = self._match(mention)
+        if not found:    # word by word, qualifier words matching nothing are dropped ('covid booster', 'COVID-19 mRNA')
+            matched = [codes for codes in map(self._match, mention.split()) if codes]
+            found = set.intersection(*matched) if matched else set()
+        found = sorted(found)
+        with self._lock:
+            self._resolved[mention] = found
+            while len(self._resolved) > VACCINE_MEMO_SIZE:
+                self._resolved.popitem(last=False)
+        return found
+
+    def _match(self, text: str, aliases: bool = True) -> set:
+        # codes starting with text, with all words of text in the description or in VAX_NAME / VAX_MANU, or of its alias
+        found = set()
+        key = _code_key(text)
+        if len(key) >= 2:
+            start = bisect.bisect_left(self._keys, (key,))
+            for k, code in self._keys[start:]:
+                if not k.startswith(key):
+                    break
+                found.add(code)
+        found |= self._match_words(text)
+        words = [word for word in _words(text) if word not in VACCINE_STOPWORDS]
+        name_words = self._name_index() if words else {}
+        if words and all(word in name_words for word in words):
+            found |= set.intersection(*(name_words[word] for word in words))
+        if aliases and text in VACCINE_ALIASES:
+            found |= self._match(VACCINE_ALIASES[text], aliases=False)
+        return found
+
+    def _match_words(self, text: str) -> set:
+        # codes with all words of text in the description (words of 4+ letters also match as prefix, 'polio' -> 'poliovirus')
+        found = None
+        for word in _words(text):
+            if word in VACCINE_STOPWORDS:
+                continue
+            codes = set(self._words.get(word, ()))
+            if len(word) >= 4:
+                start = bisect.bisect_left(self._word_list, word)
+                for other in self._word_list[start:]:
+                    if not other.startswith(word):
+                        break
+                    codes |= self._words[other]
+            found = codes if found is None else found & codes
+        return found or set()
+
+    def sub_vax_code(self, mentions: list) -> dict:
+        '''
+        Input: vaccine or disease mentions (codes included, 'MMR' also matches 'MMRV')
+        Output: sub-dict of the code table with the matching codes (sub_VAX_CODE),
+                and mentions matching no code -> VACCINE_UNMATCHED
+        '''
+        found = {}
+        for mention in mentions:
+            codes = self.resolve(mention)
+            found.update({code: self.codes[code] for code in codes} if codes else {mention: VACCINE_UNMATCHED})
+        return found
+
+    def resolve_actions(self, action_list: list) -> list:
+        '''
+        Input: list of actions and sub_VAX_CODE from data_assistant
+        Output: the same with "VAX_TYPE" traits replaced by their codes and sub_VAX_CODE filled in
+        '''
+        if not isinstance(action_list, list):
+            return action_list
+        found = {}
+        for action in action_list:
+            if isinstance(action, dict) and isinstance(action.get('filter'), dict) and 'VAX_TYPE' in action['filter']:
+                traits = action['filter']['VAX_TYPE']
+                traits = [trait for trait in (traits if isinstance(traits, list) else [traits]) if self.specific(trait)]
+                if not traits:    # vaccines in general
+                    del action['filter']['VAX_TYPE']
+                    continue
+                sub_vax_code = self.sub_vax_code(traits)    # as for query_translate
+                found.update(sub_vax_code)
+                action['filter']['VAX_TYPE'] = sorted(code for code in sub_vax_code if code in self.codes)
+        if action_list and isinstance(action_list[-1], dict) and 'filename' not in action_list[-1]:
+            action_list[-1] = found or action_list[-1]
+        else:
+            action_list.append(found)
+        return action_list
+
+
+vaccine_resolver = VaccineResolver(vaccine_code, vaccine_names)
+
+
+def query_translate(query: dict, ds = dataset_V) -> list:
+    '''
+    Input: structured query from query_extract
+    Output: list of actions in the format of data_assistant, plus a sub-dict of vaccine codes
+    '''
+    vaccines = [mention for mention in query.get('vaccines', []) if vaccine_resolver.specific(mention)]
+    sub_vax_code = vaccine_resolver.sub_vax_code(vaccines)
+    codes = sorted(code for code, name in sub_vax_code.items() if name != VACCINE_UNMATCHED)
+    years = [year for year in ds.years if not query.get('years') or year in query['years']]
+    if codes and all(code.startswith('COVID') for code in codes):
+        years = [year for year in years if year >= 2020]    # COVID vaccines only from 2020
+    ages = set()
+    for group in query.get('age_groups', []):
+        group = group.lower() if group.lower() in AGE_GROUPS else group.lower().rstrip('s')
+        if group in AGE_GROUPS:
+            low, high = AGE_GROUPS[group]
+            ages.update(range(low, high + 1))
+    if 'age_min' in query or 'age_max' in query:
+        ages.update(range(query.get('age_min', 0), query.get('age_max', 100) + 1))
+    sex = [s[0].upper() for s in query.get('sex', []) if s[:1].upper() in ('F', 'M')]
+    filters = {}
+    if vaccines:
+        filters['vax'] = {'VAX_TYPE': codes}    # empty if no mention matched, reported by summarise_retrieval
+    if ages:
+        filters.setdefault('data', {})['AGE_YRS'] = sorted(ages)
+    if len(sex) == 1:
+        filters.setdefault('data', {})['SEX'] = sex
+    if query.get('symptoms'):
+        filters['symp'] = {ANY_SYMPTOM: query['symptoms']}
+    info = {}
+    for key in query.get('info') or DEFAULT_INFO:
+        if key in INFO_COLUMNS:
+            kind, columns = INFO_COLUMNS[key]
+            info.setdefault(kind, []).extend(columns)
+    actions = []
+    for year in years:
+        for kind in VAERS_FILES:
+            if kind in filters or kind in info:
+                actions.append({'filename': f'{year}{kind}', 'filter': filters.get(kind, {}), 'info': info.get(kind, [])})
+    return actions + [sub_vax_code]
+
+
+def plan_actions(input_text: str) -> list:
+    '''
+    Input: user input
+    Output: list of actions and sub-dict of vaccine codes, as data_assistant
+    '''
+    if PLANNING_MODE == 'legacy':
+        query = input_extract(input_text)
+    else:
+        query = query_extract(input_text.strip())
+    if query is None:
+        return None
+    key = cache_key([PLANNING_MODE, query])
+    action_list = query_caches['action'].get(key)
+    if action_list is None:
+        with stage('planning'):
+            action_list = data_assistant(input_text) if PLANNING_MODE == 'legacy' else query_translate(query)
+        if action_list is not None:
+            query_caches['action'].put(key, action_list)
+    return action_list
+
+
 # # test
 # output = data_assistant('What symptoms are most common among plague vaccine receivers under age 20?')
 # print('data_assistant output type: ', type(output))
 # # test end
 
 
-# retrieved data in pandas format
-data_history = {}
+# user sessions: one chat and retrieval history per browser session
+SESSION_IDLE_SECONDS = float(os.environ.get('VAERS_SESSION_IDLE', 30 * 60))       # drop sessions idle for longer
+SESSION_HISTORY_BYTES = int(os.environ.get('VAERS_SESSION_HISTORY_BYTES', 64 * 1024**2))    # cap of data_history per session
+SESSION_CONCURRENCY = int(os.environ.get('VAERS_CONCURRENCY', 16))    # sessions served at the same time
+RETRIEVE_WORKERS = int(os.environ.get('VAERS_RETRIEVE_WORKERS', 4))   # pandas work in parallel
+retrieve_pool = concurrent.futures.ThreadPoolExecutor(max_workers=RETRIEVE_WORKERS)
 
-# user facing component
-def response(inputs, history):
+
+class Session:
+    '''
+    Chat and retrieved data (in pandas format) of one user session.
+    data_history keeps the latest retrievals, the oldest are dropped above max_bytes.
+    '''
+    def __init__(self, max_bytes: int = SESSION_HISTORY_BYTES):
+        self.chat = model.start_chat(history=[])
+        self.data_history = collections.OrderedDict()    # name -> (retrieved data, bytes)
+        self.max_bytes = max_bytes
+        self.last_used = time.time()
+        self.lock = threading.Lock()    # one turn at a time
+        self.async_lock = asyncio.Lock()    # same, for response_async
+
+    def remember(self, retrieved: dict):
+        for name, value in retrieved.items():
+            size = frame_bytes(value)
+            self.data_history.pop(name, None)
+            self.data_history[name] = (value, size)
+        total = sum(size for _, size in self.data_history.values())
+        while total > self.max_bytes and len(self.data_history) > 1:
+            total -= self.data_history.popitem(last=False)[1][1]
+
+
+class SessionStore:
+    '''
+    Sessions by Gradio session hash, dropped after idle_seconds without a request.
+    '''
+    def __init__(self, idle_seconds: float = SESSION_IDLE_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_hash: str) -> Session:
+        now = time.time()
+        with self._lock:
+            for key in [k for k, v in self._sessions.items() if now - v.last_used > self.idle_seconds]:
+                del self._sessions[key]
+            session = self._sessions.get(session_hash)
+            if session is None:
+                session = self._sessions[session_hash] = Session()
+            session.last_used = now
+            return session
+
+    def drop(self, request: gr.Request):
+        with self._lock:
+            self._sessions.pop(getattr(request, 'session_hash', None), None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+sessions = SessionStore()
+
+
+def summarise_retrieval(message: str):
+    '''
+    Input: user message
+    Output: (retrieved data or None if nothing was found, summary for the model, status for the user)
+    The planning model calls run on the calling thread, only the pandas work is queued on retrieve_pool,
+    so that sessions waiting on the model do not hold its workers.
+    '''
+    try:
+        planned = plan_retrieval(message)
+        retrieved_data, tables, summary = retrieve_pool.submit(in_context(retrieve_tables, planned)).result() \
+            if planned is not None else (None, None, None)
+    except Exception:
+        retrieved_data = None
+        print('Data not retrieved.')
+    if not retrieved_data:
+        return None, ['None'], 'no matching VAERS data.'
+    per_year = tables.get('reports per year')
+    if per_year is None or per_year.empty:
+        status = 'no matching VAERS reports.'
+    else:
+        years = per_year['YEAR']
+        span = f'{years.min()}' if years.min() == years.max() else f'{years.min()}-{years.max()}'
+        status = f'{per_year["REPORTS"].sum():,} matching VAERS reports ({span}).'
+    if retrieved_data.get('UNMATCHED'):
+        status = f'no vaccine code matches {", ".join(map(repr, retrieved_data["UNMATCHED"]))}; {status}'
+    record('payload_chars', len(summary))
+    return retrieved_data, summary, status
+
+
+def retrieve_tables(planned: tuple) -> tuple:
+    '''
+    Input: output of plan_retrieval
+    Output: (retrieved data or None, summary tables, summary for the model), the part of summarise_retrieval run in retrieve_pool
+    '''
+    with stage('retrieve'):
+        retrieved_data = execute_retrieval(planned)
+    if not retrieved_data:
+        return None, None, None
+    # only summary tables are sent to the model, not the retrieved dataframes
+    with stage('aggregate'):
+        tables = data_aggregate(retrieved_data)
+    return retrieved_data, tables, data_summary(tables, retrieved_data['VAX_CODE'])
+
+
+def prepare_message(inputs) -> list:
+    '''
+    Input: multimodal chat input
+    Output: message for the chat, text and encoded image; ValueError if the file is not an image
+    '''
     message = [inputs["text"]]
     # image processing
     if len(inputs["files"]) != 0:
         try:
-            sample_image = PIL.Image.open(inputs["files"][0]["path"])
-            message.append(sample_image)
-            info = image_assistant(sample_image)
-            history.append(info)
-            print(info)
-            if len(message[0]) == 0:
-                message[0] = f'Please summarise the input information using the following information: {info}'
+            message.append(encode_image(inputs["files"][0]["path"]))
         except Exception:
             print('Only allow image upload.')
-            yield '[File not supported]'
-            return None
-    else:
-        pass
-    # data retrieval
-    # # test ####################################
-    # retrieved_data = data_retrieve(message[0])
-    # data_history.update(retrieved_data)
-    # assistant_message = 'Here is the relevant data.'  
-    # print('Data retrieved.')
-    # # test end ################################
+            raise ValueError('File not supported')
+    return message
+
+
+IMAGE_WORKERS = int(os.environ.get('VAERS_IMAGE_WORKERS', 4))    # image analysis calls in parallel
+image_pool = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+
+def analyse_and_retrieve(message: list, history) -> tuple:
+    '''
+    Input: message from prepare_message
+    Output: (message, result of summarise_retrieval); ValueError if the image could not be analysed.
+    The image analysis (image_pool) and the data retrieval (on this thread) run concurrently,
+    except without text: the retrieval then waits for the image summary, which replaces the text.
+    '''
+    image = image_pool.submit(in_context(image_assistant, message[1])) if len(message) > 1 else None
+    retrieval = None
+    if len(message[0]) != 0 or image is None:
+        retrieval = summarise_retrieval(message[0])
+    if image is not None:
+        try:
+            info = image.result()
+        except Exception:
+            print('Image not analysed.')
+            raise ValueError('File not supported')
+        history.append(info)
+        print(info)
+        if retrieval is None:
+            message[0] = f'Please summarise the input information using the following information: {info}'
+            retrieval = summarise_retrieval(message[0])
+    return message, retrieval
+
+
+def chat_content(message: list, session: Session, retrieval) -> list:
+    # message for the chat, with the data summary from summarise_retrieval
+    retrieved_data, summary, status = retrieval
+    if retrieved_data:
+        session.remember(retrieved_data)
+        print('Data retrieved.')
+    assistant_message = 'Here is the relevant data.' if retrieved_data else 'It seems there is no relevant data.'
+    return message + [f'\n\n Data assistant: {assistant_message}\n\n', str(summary)]
+
+
+ASYNC_STREAMING = os.environ.get('VAERS_ASYNC', '0') == '1'    # serve response_async instead of response
+SAFETY_SETTINGS = {HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH}
+
+# user facing component
+def response(inputs, history, request: gr.Request = None):
+    session = sessions.get(getattr(request, 'session_hash', None) or 'default')
+    with session.lock:
+        yield from _response(inputs, history, session)
+
+
+def _response(inputs, history, session: Session):
+    # the trace is activated around each step only, gradio may run the steps of a generator in different threads
+    trace = Trace('response')
     try:
-        retrieved_data = data_retrieve(message[0])
-        if retrieved_data:
-            assistant_message = 'Here is the relevant data.'  
-            data_history.update(retrieved_data)
-            print('Data retrieved.')
-            # test line #################################
-            # print(str(retrieved_data))
-        else:
-            assistant_message = 'It seems there is no relevant data.'
-            retrieved_data = ['None']
-    except:
-        retrieved_data = 'It seems there is no relevant data.'
-        print('Data not retrieved.')
-    # generate esponse
-    response = chat.send_message(message + [f'\n\n Data assistant: {assistant_message}\n\n', str(retrieved_data)], stream=True, safety_settings={
-        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH})
-    # main 
-    # response = chat.send_message(message + ['\n\n', retrieved_data], stream=True, safety_settings={
-    #     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH})
+        yield from _traced_response(inputs, history, session, trace)
+    finally:
+        trace.finish()
+
+
+def _traced_response(inputs, history, session: Session, trace: Trace):
+    chat = session.chat
+    try:
+        with trace.activate():
+            message = prepare_message(inputs)
+    except ValueError:
+        yield '[File not supported]'
+        return None
+    # image analysis and data retrieval, the status is shown until the answer starts streaming
+    yield '*Data assistant: looking up VAERS data...*'
+    # pandas work runs in the bounded retrieve_pool
+    try:
+        with trace.activate():
+            message, retrieval = analyse_and_retrieve(message, history)
+    except ValueError:
+        yield '[File not supported]'
+        return None
+    yield f'*Data assistant: {retrieval[2]}*'
+    # generate response, every chunk is forwarded as it arrives
+    with trace.activate():
+        response = chat.send_message(chat_content(message, session, retrieval), stream=True, safety_settings=SAFETY_SETTINGS)
     full_response = ""
     for partial_response in response:
-        time.sleep(0.2)
         try:
             full_response += partial_response.text
         except Exception:
@@ -320,7 +1940,52 @@ def response(inputs, history):
             chat.rewind()
             yield '[Safety filter triggered]'
             return None
+        if full_response == partial_response.text:
+            trace.mark('first_token')
         yield full_response
+    trace.mark('last_token')
+    with trace.activate():
+        record_tokens('answer', response)
+
+
+# user facing component, async version on the Gemini async streaming API
+async def response_async(inputs, history, request: gr.Request = None):
+    session = sessions.get(getattr(request, 'session_hash', None) or 'default')
+    loop = asyncio.get_running_loop()
+    trace = Trace('response_async')
+    async with session.async_lock:
+        try:
+            chat = session.chat
+            with trace.activate():
+                prepare, retrieve = in_context(prepare_message, inputs), in_context(analyse_and_retrieve)
+            try:
+                message = await loop.run_in_executor(None, prepare)
+                yield '*Data assistant: looking up VAERS data...*'
+                message, retrieval = await loop.run_in_executor(None, retrieve, message, history)
+            except ValueError:
+                yield '[File not supported]'
+                return
+            yield f'*Data assistant: {retrieval[2]}*'
+            with trace.activate():
+                content = chat_content(message, session, retrieval)
+            response = await chat.send_message_async(content, stream=True, safety_settings=SAFETY_SETTINGS)
+            full_response = ""
+            async for partial_response in response:
+                try:
+                    full_response += partial_response.text
+                except Exception:
+                    print('Safety filter triggered.')
+                    chat.rewind()
+                    yield '[Safety filter triggered]'
+                    return
+                if full_response == partial_response.text:
+                    trace.mark('first_token')
+                yield full_response
+            trace.mark('last_token')
+            with trace.activate():
+                record_tokens('answer', response)
+        finally:
+            trace.finish()
 
 
 
@@ -339,70 +2004,430 @@ def data_filter(df: pd.DataFrame, filter: dict) -> pd.DataFrame:
     # generate intersection of IDs that have given traits
     if len(filter) == 0:
         return df
-    else:
-        IDs = None
-        for column in filter:
-            if IDs:
-                IDs &= df.loc[df[column].isin(filter[column]), "VAERS_ID"].tolist()
-            else:
-                IDs = df.loc[df[column].isin(filter[column]), "VAERS_ID"].tolist()
-        ## test line
-        # print(IDs)
-        # generate sub-dataframe with IDs
-        filtered_df = df.loc[df["VAERS_ID"].isin(IDs)]
-        return(filtered_df)
+    IDs = None
+    for column in filter:
+        mask = np.zeros(len(df), dtype=bool)
+        for c in ([c for c in SYMPTOM_COLUMNS if c in df] if column == ANY_SYMPTOM else [column]):
+            mask |= _isin(df[c], filter[column])
+        found = df.loc[mask, "VAERS_ID"].unique()
+        IDs = found if IDs is None else np.intersect1d(IDs, found)
+    # generate sub-dataframe with IDs
+    filtered_df = df.loc[df["VAERS_ID"].isin(IDs)]
+    return(filtered_df)
+
+
+def _isin(values: pd.Series, traits: list) -> np.ndarray:
+    # categorical columns are compared by their integer codes, traits not in the vocabulary match nothing
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.categories.get_indexer(pd.Index(traits, dtype=object))
+        return np.isin(values.cat.codes.to_numpy(), codes[codes >= 0])
+    return values.isin(traits).to_numpy()
 
 
-# Extraction: extract sub-dataframe with certain columns
-def data_extract(df: pd.DataFrame, filter: list) -> pd.DataFrame:
+# Planning: group the actions of data_assistant per year
+def query_plan(action_list: list, ds = dataset_V) -> dict:
     '''
-    Input: individual dataframe
-    Output: sub-dataframe with certain columns
+    Input: list of actions {"filename": filename, "filter": {column: [traits]}, "info": [columns]}
+    Output: plan {year: {'filter': {kind: {column: [traits]}}, 'output': {kind: [columns] or None}}},
+            'output' holds the files to return, with only the columns needed (None for all columns)
     '''
-    if len(filter) == 0:
-        return df
-    else:
-        return df[filter]
+    plan = {}
+    for action in action_list:
+        name = action['filename']
+        if name not in ds:
+            raise KeyError(name)
+        year, kind = int(name[:4]), name[4:]
+        step = plan.setdefault(year, {'filter': {}, 'info': {}})
+        columns = ds.columns(name)
+        for column, traits in action.get('filter', {}).items():
+            if column not in columns and (kind, column) != ('symp', ANY_SYMPTOM):
+                raise KeyError(f'{column} not in {name}')
+            traits = traits if isinstance(traits, list) else [traits]
+            if kind == 'symp' and column in (ANY_SYMPTOM, *SYMPTOM_COLUMNS):
+                traits = symptom_index(ds).expand(traits)    # plain words and near-misses -> terms in the reports
+            step['filter'].setdefault(kind, {}).setdefault(column, []).extend(traits)
+        info = [c for c in action.get('info', []) if c in columns]    # drop columns that do not exist
+        step['info'].setdefault(kind, []).extend(c for c in info if c not in step['info'][kind])
+    for step in plan.values():
+        info = step.pop('info')
+        # files with info columns are returned; without any, return the whole files that were asked for
+        output = {kind: list(dict.fromkeys(['VAERS_ID', *columns])) for kind, columns in info.items() if columns}
+        step['output'] = output or {kind: None for kind in info}
+    return plan
 
 
+# Execution: filter IDs over all files of a year, then extract the output files for these IDs
+def query_year(year: int, step: dict, ds = dataset_V) -> dict:
+    '''
+    Input: year, plan step of the year
+    Output: {kind: dataframe}
+    '''
+    with stage('index', f'index {year}'):
+        index = year_index(year, ds)
+    IDs = None
+    for kind, filter in step['filter'].items():
+        with stage('filter', f'filter {year}{kind}'):
+            found = index.resolve(kind, filter)
+            scanned = 0
+            if found is None:    # column without index, scan it
+                columns = [c for column in filter for c in (SYMPTOM_COLUMNS if column == ANY_SYMPTOM else [column])]
+                df = ds.load(f'{year}{kind}', ['VAERS_ID', *columns])
+                found = np.unique(data_filter(df, filter)['VAERS_ID'].to_numpy())
+                scanned = len(df)
+            IDs = found if IDs is None else np.intersect1d(IDs, found, assume_unique=True)
+        record_rows(f'{year}{kind}', scanned, 0)
+    result = {}
+    for kind, columns in step['output'].items():
+        with stage('file_extract', f'extract {year}{kind}'):
+            version, df = ds.load_version(f'{year}{kind}', columns)
+            if IDs is not None and version == index.mtimes.get(kind):
+                # IDs from the filter files are pushed into the output files of the same year
+                df = df.iloc[index.rows(kind, IDs)]
+            elif IDs is not None:    # file changed since the index was built (ingest), select by VAERS_ID
+                if 'VAERS_ID' not in df:
+                    df = ds.load(f'{year}{kind}', [*df.columns, 'VAERS_ID'])
+                df = df[df['VAERS_ID'].isin(IDs)]
+                df = df if columns is None or 'VAERS_ID' in columns else df.drop(columns='VAERS_ID')
+            result[kind] = df
+        record_rows(f'{year}{kind}', 0, len(df))
+    return result
+
+
+QUERY_WORKERS = int(os.environ.get('VAERS_QUERY_WORKERS', 4))
+query_pool = concurrent.futures.ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+def query_execute(plan: dict, ds = dataset_V) -> dict:
+    '''
+    Input: plan from query_plan
+    Output: {kind: dataframe}, the results of all years combined with a 'YEAR' column
+    '''
+    years = sorted(plan)
+    futures = [query_pool.submit(in_context(query_year, year, plan[year], ds)) for year in years]
+    results = [future.result() for future in futures]
+    combined = {}
+    for year, result in zip(years, results):
+        for kind, df in result.items():
+            combined.setdefault(kind, []).append(df.assign(YEAR=year))
+    return {kind: pd.concat(ds.align(frames), ignore_index=True) for kind, frames in combined.items()}
+
 
 # Retrieval: yield final retrieved data for user-facing component
-def data_retrieve(input: str, ds = dataset_V) -> str:
+def plan_retrieval(input: str, ds = dataset_V) -> tuple:
     '''
-    Input: list from data_assistant
-    Output: csv and dict in 'str'
+    Input: user input, passed to plan_actions
+    Output: (actions, sub-dict of vaccine codes, retrieve cache key), None if no data is requested
     '''
-    # # test line
-    # action_list = data_assistant(input)
     try:
-        action_list = data_assistant(input)
-        file_nr = len(action_list)
-    except:
+        action_list = plan_actions(input)
+        if action_list is None:
+            print('Data not requested.')
+            return None
+        # {"filename": filename, "filter": {"trait_column_1": ["trait"], etc}, "info": ["info_column", etc]}, ..., sub_VAX_CODE
+        actions = [action for action in action_list if isinstance(action, dict) and 'filename' in action]
+        vax_code = action_list[-1] if isinstance(action_list[-1], dict) and 'filename' not in action_list[-1] else {}
+        # keyed on the csv versions too, so that updated data is not answered from the cache
+        key = cache_key([action_list, {name: ds.source_mtime(name) if name in ds else None for name in sorted({str(a['filename']) for a in actions})}])
+    except Exception as e:
+        print('Data retrieval failed: Incorrect format ', e)
         return None
-    data_hist = {}
-    # # test line
-    # print(action_list)
-    for i in range(file_nr-1):
-        action = action_list[i]# {"filename_1": filename, "filter": {"trait_column_1": ["trait"], etc}, "info": ["info_column", etc]}
-
-        # # test
-        # file_ds = ds[action['filename']]
-        # filter = action['filter']
-        # info = action['info']
-        # # test end
+    return actions, vax_code, key
 
+
+def execute_retrieval(planned: tuple, ds = dataset_V) -> dict:
+    '''
+    Input: output of plan_retrieval
+    Output: as data_retrieve
+    '''
+    actions, vax_code, key = planned
+    data_hist = query_caches['retrieve'].get(key)
+    if data_hist is not None:
+        print('Data retrieved from cache.')
+        return data_hist
+    try:
+        plan = query_plan(actions, ds)
+    except Exception as e:
+        print('Data retrieval failed: Incorrect format ', e)
+        return None
+    with stage('cube'):
+        tables = cube_answer(plan, ds)
+    if tables is not None:
+        print('Data retrieved from cube.')
+        data_hist = {'tables': tables}
+    else:
+        data_hist = query_execute(plan, ds)
+    data_hist['VAX_CODE'] = str(vax_code)
+    data_hist['UNMATCHED'] = [mention for mention, name in vax_code.items() if name == VACCINE_UNMATCHED]
+    query_caches['retrieve'].put(key, data_hist)
+    return data_hist
+
+
+def data_retrieve(input: str, ds = dataset_V) -> dict:
+    '''
+    Input: user input, passed to plan_actions
+    Output: {kind: dataframe} combined over all years (or {'tables': summary tables} if answered from the cube),
+            plus 'VAX_CODE' in 'str'
+    '''
+    planned = plan_retrieval(input, ds)
+    return execute_retrieval(planned, ds) if planned is not None else None
+
+
+AGE_BANDS = [0, 3, 12, 18, 35, 60, np.inf]
+AGE_LABELS = ['0-2', '3-11', '12-17', '18-34', '35-59', '60+']
+FLAG_COLUMNS = ['DIED', 'L_THREAT', 'ER_VISIT', 'HOSPITAL', 'DISABLE', 'BIRTH_DEFECT']    # 'Y' or empty in '{year}data'
+TOP_N = 15
+PAYLOAD_BUDGET = int(os.environ.get('VAERS_PAYLOAD_BUDGET', 6000))    # max characters of data sent to the model
+
+# Aggregation: summary tables of the retrieved data, counted in reports (unique VAERS_ID)
+def data_aggregate(retrieved: dict, top_n: int = TOP_N) -> dict:
+    '''
+    Input: output of data_retrieve
+    Output: {title: small dataframe}
+    '''
+    if 'tables' in retrieved:    # already aggregated by cube_answer
+        return retrieved['tables']
+    frames = {kind: df for kind, df in retrieved.items() if isinstance(df, pd.DataFrame)}
+    tables = {}
+    if not frames:
+        return tables
+    reports = pd.concat([df[['YEAR', 'VAERS_ID']] for df in frames.values()]).drop_duplicates()
+    tables['reports per year'] = reports.groupby('YEAR').size().rename('REPORTS').reset_index()
+    done = {'VAERS_ID', 'YEAR'}
+    for kind, df in frames.items():
+        symptoms = [c for c in SYMPTOM_COLUMNS if c in df.columns]
+        if symptoms:
+            terms = df.melt(id_vars=['YEAR', 'VAERS_ID'], value_vars=symptoms, value_name='SYMPTOM').dropna(subset=['SYMPTOM'])
+            terms = terms.drop_duplicates(['VAERS_ID', 'SYMPTOM'])
+            top = terms['SYMPTOM'].value_counts().head(top_n)
+            top = top[top > 0]    # categories without reports
+            tables['top symptoms'] = top.rename('REPORTS').rename_axis('SYMPTOM').reset_index()
+            if terms['YEAR'].nunique() > 1:
+                trend = terms[terms['SYMPTOM'].isin(top.index[:5])]
+                tables['top symptoms per year'] = pd.crosstab(trend['YEAR'], trend['SYMPTOM'].astype(object)).reset_index()
+            done.update(symptoms)
+            done.update(c.replace('SYMPTOM', 'SYMPTOMVERSION') for c in symptoms)
+        if 'AGE_YRS' in df.columns:
+            people = df.drop_duplicates('VAERS_ID')
+            band = pd.cut(people['AGE_YRS'], AGE_BANDS, right=False, labels=AGE_LABELS)
+            band = band.cat.add_categories('unknown').fillna('unknown')
+            if 'SEX' in df.columns:
+                by_band = pd.crosstab(band, people['SEX'].astype(object)).reindex(band.cat.categories, fill_value=0)
+                tables['reports by age band and sex'] = by_band.rename_axis('AGE').reset_index()
+                done.add('SEX')
+            else:
+                tables['reports by age band'] = band.value_counts(sort=False).rename('REPORTS').rename_axis('AGE').reset_index()
+            tables['age statistics'] = people['AGE_YRS'].describe().round(1).rename_axis('STAT').reset_index()
+            done.add('AGE_YRS')
+        flags = [c for c in FLAG_COLUMNS if c in df.columns]
+        if flags:
+            people = df.drop_duplicates('VAERS_ID')
+            tables['serious outcomes per year'] = (people[flags] == 'Y').groupby(people['YEAR']).sum().reset_index()
+            done.update(flags)
+        for column in df.columns:
+            if column in done:
+                continue
+            done.add(column)
+            values = df.drop_duplicates(['VAERS_ID', column])[column].dropna().astype(str)
+            if len(values) and values.str.len().mean() > 50:    # free text, show a few samples
+                tables[f'{column} samples'] = values.head(3).str[:300].to_frame()
+            else:
+                tables[f'reports by {column}'] = values.value_counts().head(top_n).rename('REPORTS').rename_axis(column).reset_index()
+    return tables
+
+
+def data_summary(tables: dict, vax_code: str = '', budget: int = PAYLOAD_BUDGET) -> str:
+    '''
+    Input: tables from data_aggregate, sub_VAX_CODE
+    Output: tables in csv format, with rows trimmed (longest table first) to stay within budget characters
+    '''
+    shown = {title: len(table) for title, table in tables.items()}
+    while True:
+        parts = [f'Vaccine codes: {vax_code}'] if vax_code else []
+        for title, table in tables.items():
+            note = f' (top {shown[title]} of {len(table)} rows)' if shown[title] < len(table) else ''
+            parts.append(f'{title}{note}:\n' + table.head(shown[title]).to_csv(index=False))
+        text = '\n'.join(parts)
+        longest = max(shown, key=shown.get, default=None)
+        if len(text) <= budget or longest is None or shown[longest] <= 1:
+            return text[:budget]
+        shown[longest] //= 2
+
+
+CUBE_PATH = f'{CACHE_DIR}/cube.parquet'                  # reports per (VAX_SET, YEAR, AGE, SEX)
+CUBE_SYMPTOM_PATH = f'{CACHE_DIR}/cube_symp.parquet'     # reports per (VAX_SET, YEAR, AGE, SEX, SYMPTOM)
+CUBE_DIMS = ['VAX_SET', 'YEAR', 'AGE', 'SEX']
+CUBE_FILTERS = {('vax', 'VAX_TYPE'), ('data', 'AGE_YRS'), ('data', 'SEX')}
+# a filter on one symptom term is answered from the symptom cube, which counts the reports per term,
+# but has no serious-outcome flags nor co-occurring symptoms (and reports with any of several terms cannot be added up)
+CUBE_SYMPTOM_FILTER = ('symp', ANY_SYMPTOM)
+CUBE_INFO = {'VAERS_ID', 'VAX_TYPE', 'AGE_YRS', 'SEX', *FLAG_COLUMNS, *SYMPTOM_COLUMNS,
+             *[c.replace('SYMPTOM', 'SYMPTOMVERSION') for c in SYMPTOM_COLUMNS]}
+
+# Cube: precomputed report counts for the common vaccine x year x age x sex x symptom questions
+def build_cube(ds = dataset_V, years = None) -> None:
+    '''
+    Count reports per (VAX_SET, YEAR, AGE, SEX) with serious-outcome flags, and per symptom (python main.py build-cube).
+    VAX_SET is the '+'-joined set of vaccine codes of a report, so reports with several vaccines are counted once.
+    AGE is AGE_YRS in whole years (-1 if unknown). Only years with all three files are included.
+    With years, only these years are counted again, the other years of ds are kept from the saved cube.
+    '''
+    reports, symptoms, sources = [], [], {}
+    if years is not None and pyarrow is not None and os.path.exists(CUBE_PATH) and os.path.exists(CUBE_SYMPTOM_PATH):
+        kept = set(ds.years) - set(years)
+        for path, frames in [(CUBE_PATH, reports), (CUBE_SYMPTOM_PATH, symptoms)]:
+            table = pq.read_table(path)
+            cube = table.to_pandas()
+            frames.append(cube[cube['YEAR'].isin(kept)].astype({c: object for c in ['VAX_SET', 'SEX', 'SYMPTOM'] if c in cube}))
+        sources.update({name: mtime for name, mtime in json.loads(table.schema.metadata[b'vaers_sources']).items() if int(name[:4]) in kept})
+    else:
+        years = ds.years
+    for year in years:
         try:
-            file_ds = ds[action['filename']]
-            filter = action['filter']
-            info = action['info']
-        except:
-            print('Data retrieval failed: Incorrect format ', action)
+            flags = [c for c in FLAG_COLUMNS if c in ds.columns(f'{year}data')]
+            data = ds.load(f'{year}data', ['VAERS_ID', 'AGE_YRS', 'SEX', *flags])
+            vax = ds.load(f'{year}vax', ['VAERS_ID', 'VAX_TYPE']).astype({'VAX_TYPE': object})
+            symp = ds.load(f'{year}symp', ['VAERS_ID', *SYMPTOM_COLUMNS])
+        except (KeyError, FileNotFoundError):
+            print(f'Skipped {year}: files not found.')
+            continue
+        sources.update({f'{year}{kind}': ds.source_mtime(f'{year}{kind}') for kind in VAERS_FILES})
+        vax_set = vax.dropna().drop_duplicates().sort_values('VAX_TYPE').groupby('VAERS_ID')['VAX_TYPE'].agg('+'.join)
+        keys = pd.DataFrame({'VAERS_ID': data['VAERS_ID'], 'YEAR': year,
+                             'VAX_SET': data['VAERS_ID'].map(vax_set).fillna(''),
+                             'AGE': np.floor(data['AGE_YRS']).fillna(-1).astype('int16'),
+                             'SEX': data['SEX'].astype(object).fillna('U')})
+        for flag in FLAG_COLUMNS:
+            keys[flag] = data[flag].eq('Y') if flag in flags else False
+        keys = keys.drop_duplicates('VAERS_ID')
+        reports.append(keys.groupby(CUBE_DIMS).agg(REPORTS=('VAERS_ID', 'size'), **{f: (f, 'sum') for f in FLAG_COLUMNS}).reset_index())
+        terms = symp.melt(id_vars='VAERS_ID', value_vars=SYMPTOM_COLUMNS, value_name='SYMPTOM')[['VAERS_ID', 'SYMPTOM']]
+        terms = terms.dropna().drop_duplicates().merge(keys[['VAERS_ID', *CUBE_DIMS]], on='VAERS_ID')
+        symptoms.append(terms.groupby([*CUBE_DIMS, 'SYMPTOM'], observed=True).size().rename('REPORTS').reset_index())
+        print(f'Cube: {year} done.')
+    if not reports:
+        return
+    metadata = {b'vaers_sources': json.dumps(sources).encode()}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for path, frames in [(CUBE_PATH, reports), (CUBE_SYMPTOM_PATH, symptoms)]:
+        cube = pd.concat(frames, ignore_index=True)
+        for column in ['VAX_SET', 'SEX', 'SYMPTOM']:
+            if column in cube:
+                cube[column] = cube[column].astype('category')
+        table = pyarrow.Table.from_pandas(cube, preserve_index=False)
+        tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        pq.write_table(table.replace_schema_metadata({**table.schema.metadata, **metadata}), tmp)
+        os.replace(tmp, path)
+    print(f'Cube saved to {CUBE_PATH}.')
+
+
+_cube = {}    # path -> (file mtime, csv mtimes, dataframe)
+_cube_stale = set()    # file mtimes of the cubes reported out of date, each reported once
+_cube_lock = threading.Lock()
+
+def load_cube(ds = dataset_V):
+    '''
+    Output: (reports cube, symptom cube, years covered), None if not built or out of date
+    The files are read again when rebuilt (by build-cube or ingest) while the app runs.
+    '''
+    if pyarrow is None:
+        return None
+    with _cube_lock:
+        try:
+            for path in [CUBE_PATH, CUBE_SYMPTOM_PATH]:
+                mtime = os.path.getmtime(path)
+                if path not in _cube or _cube[path][0] != mtime:
+                    table = pq.read_table(path, memory_map=True)
+                    _cube[path] = (mtime, json.loads(table.schema.metadata[b'vaers_sources']), table.to_pandas())
+        except FileNotFoundError:
             return None
-        filtered_df = data_filter(file_ds, filter)
-        extract_df = data_extract(filtered_df, info)
-        data_hist[action['filename']] = extract_df
-    data_hist['VAX_CODE'] = str(action_list[-1])
-    return data_hist
+        reports, symptoms = _cube[CUBE_PATH], _cube[CUBE_SYMPTOM_PATH]
+    sources = reports[1]
+    if symptoms[1] != sources:    # one of the two files is being rebuilt
+        return None
+    if any(ds.source_mtime(name) != mtime for name, mtime in sources.items()):
+        with _cube_lock:
+            if reports[0] not in _cube_stale:
+                _cube_stale.add(reports[0])
+                print('Cube out of date, run "python main.py build-cube".')
+        return None
+    return reports[2], symptoms[2], {int(name[:4]) for name in sources}
+
+
+def _cube_rows(cube: pd.DataFrame, plan: dict) -> pd.DataFrame:
+    # rows of the cube matching the filters of each year in the plan
+    vax_sets = cube['VAX_SET'].cat.categories
+    mask = np.zeros(len(cube), dtype=bool)
+    for year, step in plan.items():
+        year_mask = cube['YEAR'] == year
+        for kind, filter in step['filter'].items():
+            for column, traits in filter.items():
+                if column == 'VAX_TYPE':
+                    matching = [s for s in vax_sets if set(s.split('+')) & set(traits)]
+                    year_mask &= cube['VAX_SET'].isin(matching)
+                elif column == 'AGE_YRS':
+                    ages = [int(float(t)) for t in traits if str(t).replace('.', '', 1).isdigit()]
+                    year_mask &= cube['AGE'].isin(ages)
+                else:
+                    year_mask &= cube[column].isin(traits)
+        mask |= year_mask.to_numpy()
+    return cube[mask]
+
+
+def cube_answer(plan: dict, ds = dataset_V, top_n: int = TOP_N):
+    '''
+    Input: plan from query_plan
+    Output: tables as in data_aggregate, None if the plan is outside the cube dimensions
+    '''
+    info = set()
+    for step in plan.values():
+        for kind, filter in step['filter'].items():
+            if any((kind, column) not in CUBE_FILTERS | {CUBE_SYMPTOM_FILTER} for column in filter):
+                return None
+        for columns in step['output'].values():
+            if columns is None or not set(columns) <= CUBE_INFO:
+                return None
+            info.update(columns)
+    kind, column = CUBE_SYMPTOM_FILTER
+    symptom_filters = [step['filter'].get(kind, {}).get(column) for step in plan.values()]    # traits per year
+    if any(traits is not None for traits in symptom_filters):    # the same single term in every year
+        if any(traits is None for traits in symptom_filters) or len({t for traits in symptom_filters for t in traits}) != 1 \
+                or any(len(set(traits)) != 1 for traits in symptom_filters) or info & {*FLAG_COLUMNS, *SYMPTOM_COLUMNS}:
+            return None
+    cube = load_cube(ds)
+    if cube is None or not set(plan) <= cube[2]:
+        return None
+    # with a symptom filter, the reports are the rows of the symptom cube for that term
+    reports = _cube_rows(cube[1] if symptom_filters and symptom_filters[0] is not None else cube[0], plan)
+    tables = {'reports per year': reports.groupby('YEAR')['REPORTS'].sum().reset_index()}
+    if info & set(SYMPTOM_COLUMNS):
+        symptoms = _cube_rows(cube[1], plan)
+        top = symptoms.groupby('SYMPTOM', observed=True)['REPORTS'].sum().nlargest(top_n)
+        tables['top symptoms'] = top.reset_index()
+        if len(plan) > 1:
+            trend = symptoms[symptoms['SYMPTOM'].isin(top.index[:5])]
+            trend = trend.groupby(['YEAR', trend['SYMPTOM'].astype(str)])['REPORTS'].sum().unstack(fill_value=0)
+            tables['top symptoms per year'] = trend.reset_index()
+    # the same tables as data_aggregate, every age band included
+    if 'AGE_YRS' in info:
+        band = pd.cut(reports['AGE'].where(reports['AGE'] >= 0), AGE_BANDS, right=False, labels=AGE_LABELS)
+        band = band.cat.add_categories('unknown').fillna('unknown').rename('AGE')
+        if 'SEX' in info:
+            by_band = reports.groupby([band, reports['SEX'].astype(str)], observed=True)['REPORTS'].sum().unstack(fill_value=0)
+            tables['reports by age band and sex'] = by_band.reindex(band.cat.categories, fill_value=0).rename_axis('AGE').reset_index()
+        else:
+            tables['reports by age band'] = reports.groupby(band, observed=False)['REPORTS'].sum().reset_index()
+        # from AGE in whole years, so the mean and quantiles may differ from data_aggregate below one year
+        known = reports[reports['AGE'] >= 0]
+        ages = pd.Series(np.repeat(known['AGE'].to_numpy(), known['REPORTS'].to_numpy()), name='AGE_YRS', dtype=float)
+        tables['age statistics'] = ages.describe().round(1).rename_axis('STAT').reset_index()
+    elif 'SEX' in info:
+        tables['reports by SEX'] = reports.groupby('SEX', observed=True)['REPORTS'].sum().nlargest(top_n).reset_index()
+    flags = [c for c in FLAG_COLUMNS if c in info]
+    if flags:
+        tables['serious outcomes per year'] = reports.groupby('YEAR')[flags].sum().reset_index()
+    if 'VAX_TYPE' in info:
+        by_vax = reports.assign(VAX_TYPE=reports['VAX_SET'].astype(str).str.split('+')).explode('VAX_TYPE')
+        tables['reports by VAX_TYPE'] = by_vax.groupby('VAX_TYPE')['REPORTS'].sum().nlargest(top_n).reset_index()
+    return tables
 
 
 # # test
@@ -412,17 +2437,107 @@ def data_retrieve(input: str, ds = dataset_V) -> str:
 
 
 
+########################## Ingestion ###########################
+INGEST_INTERVAL = float(os.environ.get('VAERS_INGEST_INTERVAL', 0))    # seconds between checks for new data, 0 to disable
+_ingest_lock = threading.Lock()
+
+def _built_from(ds = dataset_V) -> dict:
+    # file name -> csv mtimes this process built its frames, indexes and symptom index from
+    built = collections.defaultdict(set)
+    with ds._lock:
+        for name, entry in ds._frames.items():
+            built[name].add(entry[0])
+    with _index_lock:
+        indexes = list(year_indexes.values())
+    for index in indexes:
+        for kind, mtime in index.mtimes.items():
+            built[f'{index.year}{kind}'].add(mtime)
+    for index in list(symptom_indexes.values()):
+        for year, mtime in index.mtimes.items():
+            built[f'{year}symp'].add(mtime)
+    return built
+
+
+def _cube_stale_years(ds = dataset_V) -> set:
+    # years of the saved cube counted from other csv versions than the current ones
+    if pyarrow is None or not os.path.exists(CUBE_PATH):
+        return set()
+    sources = json.loads(pq.read_schema(CUBE_PATH).metadata[b'vaers_sources'])
+    return {int(name[:4]) for name, mtime in sources.items() if ds.source_mtime(name) != mtime}
+
+
+def ingest(ds = dataset_V) -> dict:
+    '''
+    Pick up new and appended VAERS files while serving (python main.py ingest, POST /ingest, or every INGEST_INTERVAL).
+    A file counts as updated if its csv differs from the version its Parquet copy, or this process's frames
+    and indexes, were made from, so files already converted by another process (the ingest CLI) are picked up too.
+    Appended rows extend the Parquet copies and loaded frames. Year indexes are rebuilt by year_index; they carry
+    the version of the frames they index, and a query still holding an older index selects rows by VAERS_ID instead.
+    Output: {'new_years': [...], 'updated': [file names], 'cube_years': [...], 'seconds': ...}
+    '''
+    with _ingest_lock:
+        start = time.time()
+        new_years = [year for year in discover_years(ds.data_dir, ds.cache_dir) if year not in ds.years]
+        ds.incoming = set(new_years)
+        built = _built_from(ds)
+        updated = [name for name in (f'{year}{kind}' for year in ds.years for kind in VAERS_FILES)
+                   if ds.is_stale(name) or any(mtime != ds.source_mtime(name) for mtime in built.get(name, ()))]
+        changed = sorted({int(name[:4]) for name in updated} | set(new_years))
+        cube_years = sorted(_cube_stale_years(ds) | set(new_years)) if os.path.exists(CUBE_PATH) else []    # not rebuilt if done by the CLI
+        if not changed and not cube_years:
+            ds.incoming = set()
+            return {'new_years': [], 'updated': [], 'cube_years': [], 'seconds': round(time.time() - start, 3)}
+        for name in updated:
+            ds.refresh(name)
+        for year in changed:
+            year_index(year, ds)    # rebuilt if a file changed
+        if cube_years:
+            build_cube(ds, cube_years)
+        ds.years = sorted({*ds.years, *new_years})
+        ds.incoming = set()
+        with _cube_lock:
+            _cube.clear()
+        query_caches['retrieve'].clear()    # keyed on csv mtimes, cleared to free the memory
+        if new_years:    # extracted years and prompts mention the span of years
+            for name in ['extract', 'semantic', 'action']:
+                query_caches[name].clear()
+            global model
+            model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=chat_instruction(ds))
+            forget_static_models()
+            vaccine_resolver.forget()    # VAX_NAME / VAX_MANU of the new years
+        symptom_index(ds)
+        result = {'new_years': new_years, 'updated': updated, 'cube_years': cube_years, 'seconds': round(time.time() - start, 3)}
+        print('Ingested:', result)
+        return result
+
+
+def start_ingest_watcher(interval: float = INGEST_INTERVAL, ds = dataset_V):
+    # check for new data every interval seconds
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                ingest(ds)
+            except Exception as e:
+                print('Ingestion failed:', e)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+
 ########################## Assemble chatbot ###########################
 
 with gr.Blocks(fill_height=True, fill_width=True) as demo:
     chatbot = gr.ChatInterface(
-        fn=response,
+        fn=response_async if ASYNC_STREAMING else response,
         title="VAERS Vaccine Database Assitant",
         multimodal=True,
         description='An assistant for accessing the VAERS data from the past 10 years. **Warning: Not suitable for actual medical practice.**',
         examples=[{'text':"Are children or seniors more susceptible to COVID vaccine side effects?"},\
                    {'text':"What are the most common side effects from flu vaccine among children?"}]
     )
+    demo.unload(sessions.drop)
+
+demo.queue(default_concurrency_limit=SESSION_CONCURRENCY)
 
 
 
@@ -433,12 +2548,30 @@ if "demo" in locals() and demo.is_running:
 
 
 if __name__ == "__main__":
-    demo.launch()
+    if sys.argv[1:] == ['build-cache']:
+        build_cache(dataset_V)
+    elif sys.argv[1:] == ['build-cube']:
+        build_cube(dataset_V)
+    elif sys.argv[1:] == ['memory-report']:
+        memory_report(dataset_V)
+    elif sys.argv[1:] == ['ingest']:
+        ingest(dataset_V)    # refresh the cached copies, then tell a running app to pick up the new data
+        if METRICS_PORT:
+            try:
+                request = urllib.request.Request(f'http://127.0.0.1:{METRICS_PORT}/ingest', method='POST')
+                print('Running app:', urllib.request.urlopen(request, timeout=600).read().decode())
+            except OSError:
+                print('No running app found.')
+    else:
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+        if INGEST_INTERVAL:
+            start_ingest_watcher(INGEST_INTERVAL)
+        demo.launch()
 
 
 
 # problem1: must terminate manually
 # problem2: gradio textbox is partially blank
-# problem3: cannot perform statistics
 # problem4: cannot perform too complicated filtering with boolean operations
 # problem5: Irrelevant data is requested, eg 'hello' gets data back
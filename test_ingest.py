@@ -0,0 +1,88 @@
+'''
+Ingestion of updated VAERS files while serving (python -m pytest test_ingest.py).
+The files are synthetic (benchmark.make_dataset), counts are checked against plain pandas on the csv files.
+'''
+import os
+import atexit
+import pandas as pd
+import pytest
+
+import benchmark    # sets the environment main is imported with
+import main
+
+atexit.unregister(main.save_query_caches)    # do not overwrite the query caches of the app
+YEARS = [2020, 2021]
+
+
+@pytest.fixture
+def ds(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    benchmark.make_dataset(root, YEARS, 500, list(main.vaccine_code))
+    monkeypatch.setattr(main, 'CUBE_PATH', f'{root}/cache/cube.parquet')
+    monkeypatch.setattr(main, 'CUBE_SYMPTOM_PATH', f'{root}/cache/cube_symp.parquet')
+    for state in [main.year_indexes, main.symptom_indexes, main._cube]:
+        state.clear()
+    yield main.LazyDataset(YEARS, data_dir=root, cache_dir=f'{root}/cache')
+    for state in [main.year_indexes, main.symptom_indexes, main._cube]:
+        state.clear()
+
+
+def csv_path(ds, name: str) -> str:
+    return f'{ds.data_dir}/{name[:4]}VAERSData/{name[:4]}{main.VAERS_FILES[name[4:]]}.csv'
+
+
+def touch(path: str):
+    # a later mtime than the converted version, whatever the resolution of the file system
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+
+
+def counts(ds) -> dict:
+    '''
+    Output: {question: (reports from query_execute, reports from pandas on the csv files)}
+    '''
+    flu = main.query_plan([{'filename': '2021vax', 'filter': {'VAX_TYPE': ['FLU3']}, 'info': ['VAX_TYPE']},
+                           {'filename': '2021data', 'filter': {}, 'info': ['AGE_YRS']}], ds)
+    headache = main.query_plan([{'filename': '2020symp', 'filter': {main.ANY_SYMPTOM: ['Headache']}, 'info': []},
+                                {'filename': '2020data', 'filter': {'SEX': ['F']}, 'info': ['SEX']}], ds)
+    vax = pd.read_csv(csv_path(ds, '2021vax'))
+    symp = pd.read_csv(csv_path(ds, '2020symp'))
+    data = pd.read_csv(csv_path(ds, '2020data'))
+    terms = headache[2020]['filter']['symp'][main.ANY_SYMPTOM]
+    with_terms = symp.loc[symp[main.SYMPTOM_COLUMNS].isin(terms).any(axis=1), 'VAERS_ID']
+    women = data.loc[data['SEX'] == 'F', 'VAERS_ID']
+    return {'flu': (main.query_execute(flu, ds)['data']['VAERS_ID'].nunique(),
+                    vax.loc[vax['VAX_TYPE'] == 'FLU3', 'VAERS_ID'].nunique()),
+            'headache': (main.query_execute(headache, ds)['data']['VAERS_ID'].nunique(),
+                         len(set(with_terms) & set(women)))}
+
+
+def test_ingest_appended_and_rewritten_files(ds):
+    main.build_cache(ds)
+    before = counts(ds)    # frames and year indexes of the old files are loaded
+    assert all(found == expected for found, expected in before.values()), before
+
+    # rows appended to one csv: a flu vaccine for 50 more reports of 2021
+    path = csv_path(ds, '2021vax')
+    vax = pd.read_csv(path)
+    extra = vax[vax['VAX_TYPE'] != 'FLU3'].drop_duplicates('VAERS_ID').head(50).assign(VAX_TYPE='FLU3', VAX_NAME='FLU3')
+    extra.to_csv(path, mode='a', header=False, index=False)
+    touch(path)
+    # another csv rewritten: 2020 symptoms without the first 100 reports, Nausea as second symptom becomes Headache
+    path = csv_path(ds, '2020symp')
+    symp = pd.read_csv(path).iloc[100:]
+    symp.loc[symp['SYMPTOM2'] == 'Nausea', 'SYMPTOM2'] = 'Headache'
+    symp.to_csv(path, index=False)
+    touch(path)
+
+    result = main.ingest(ds)
+    assert sorted(result['updated']) == ['2020symp', '2021vax']
+    assert result['new_years'] == []
+    # Parquet copies, loaded frames and year indexes are all of the new versions before the next query
+    assert not any(ds.is_stale(name) for name in result['updated'])
+    assert all(mtimes == {ds.source_mtime(name)} for name, mtimes in main._built_from(ds).items())
+    after = counts(ds)
+    assert all(found == expected for found, expected in after.values()), after
+    assert after['flu'][0] == before['flu'][0] + 50
+    assert after['headache'][0] != before['headache'][0]
+    assert main.ingest(ds)['updated'] == []